@@ -16,22 +16,201 @@ import sys
 import os
 import re
 import time
+import datetime
+import hashlib
+import tempfile
+import itertools
+import bisect
+import heapq
+import csv
+import json
+import marshal
+import sqlite3
+import cPickle as pickle
+import multiprocessing
+import shlex
+import copy
+
+from collections import OrderedDict, namedtuple
+from cStringIO import StringIO
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 
 from optparse import OptionParser, OptionGroup
 
 ######## globals #########
 
-# global stuff
-global debug
-debug=False
+# version of the entries read_rooster produces; change this whenever
+# they change, so cached entries from an older parser are not used:
+parser_version=4
+
+# version of the events render_ical_event produces; change this whenever
+# they change, so --update re-renders events written by an older version:
+render_version=5
+
+# the time zone of the schedule: events are written in its local time, and
+# every calendar holds its definition (with the EU summer time rules, from
+# the last Sunday of March to the last Sunday of October, at 01:00 UTC):
+ics_tzid = "Europe/Amsterdam"
+ics_timezone = [ "BEGIN:VTIMEZONE",
+                 "TZID:"+ics_tzid,
+                 "BEGIN:DAYLIGHT",
+                 "TZOFFSETFROM:+0100",
+                 "TZOFFSETTO:+0200",
+                 "TZNAME:CEST",
+                 "DTSTART:19810329T020000",
+                 "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU",
+                 "END:DAYLIGHT",
+                 "BEGIN:STANDARD",
+                 "TZOFFSETFROM:+0200",
+                 "TZOFFSETTO:+0100",
+                 "TZNAME:CET",
+                 "DTSTART:19961027T030000",
+                 "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU",
+                 "END:STANDARD",
+                 "END:VTIMEZONE" ]
 
 # which column to look for (optional) groups:
 groupcol=9
+# which column to look for day of week (optional):
+weekdaycol=2
+
+# how to recognize times and dates:
+time_pattern = '[0-9][0-9]*:[0-9][0-9]'
+date_pattern = '[0-9][0-9]*/[0-9][0-9]*/[0-9][0-9]'
+# format checking for each column ('' means free text, not checked):
+column_patterns = [ '',		# status (usually empty)
+                    '[A-Z0-9_]*',	# course code X_405052
+                    '([A-Z]|)[a-z][a-z]', # weekday, like 'di' or 'Tue' (opt.)
+                    date_pattern,	# date 3/9/13
+                    '[0-9, -]*',	# week numbers 36-42, 44
+                    time_pattern,	# start time 13:30
+                    time_pattern,	# end time 15:15
+                    '',		# course name free text
+                    '',		# description free text
+                    '',            # groups free text (optional)
+                    '[A-Z][A-Z]']	# type, like HC, WC, PR
+
+# one rooster entry, with its fields parsed: Dag is the ics day name (or
+# None), Begindatum a ( YYYY, MM, DD ) tuple, Weken a tuple of week numbers,
+# Start and Einde are minutes of the day; the other fields are text:
+Entry = namedtuple('Entry', [ 'Status', 'Vakcode', 'Dag', 'Begindatum',
+                              'Weken', 'Start', 'Einde', 'Vaknaam',
+                              'Beschrijving', 'Groep', 'Type', 'Zalen',
+                              'Docent', 'Opmerking' ])
+
+# names of the columns, for reporting:
+column_names = [ 'Status', 'Vakcode', 'Dag', 'Begindatum', 'Kal.wkn', 'Start',
+                 'Einde', 'Vaknaam', 'Beschrijving', 'Groep', 'Type', 'Zalen',
+                 'Docent', 'Opmerking' ]
+
+# lines above the rows of one day, in the weekday layout:
+weekday_names = set([ 'maandag', 'dinsdag', 'woensdag', 'donderdag',
+                      'vrijdag', 'monday', 'tuesday', 'wednesday',
+                      'thursday', 'friday' ])
+
+# the line of dates above each table, in the v1 layout (05 Sep 2016 - ...):
+v1_date_pattern = '[0-9][0-9]* [A-Za-z]+ [0-9]{4} - '
+
+# compiled row schemas, one per header layout (see row_schema):
+_row_schemas={}
+
+# to convert day names to ics standards
+ics_day = { 
+    'ma':'MO', 
+    'di':'TU', 
+    'wo':'WE', 
+    'do':'TH', 
+    'vr':'FR', 
+    'za':'SA', 
+    'zo':'SU', 
+    'mo':'MO', 
+    'tu':'TU', 
+    'we':'WE', 
+    'th':'TH', 
+    'fr':'FR', 
+    'sa':'SA', 
+    'su':'SU', 
+    }
     
+######## STATISTICS ##########
+
+# stages timed for --stats:
+stages = [ 'read', 'parse', 'dedup', 'render', 'write' ]
+
+class Stats(object):
+    ''' wall time per stage, and counts of the lines read, rows stored and
+    lines skipped (by reason), for --stats '''
+    
+    def __init__(self):
+        self.times = dict( (stage, 0.) for stage in stages )
+        self.files = 0
+        self.cached = 0
+        self.lines = 0
+        self.rows = 0
+        self.events = 0
+        self.skipped = {}
+    
+    def skip(self, reason):
+        ''' counts a line skipped for <reason> '''
+        self.skipped[reason] = self.skipped.get(reason, 0)+1
+    
+    def add(self, other):
+        ''' adds the counts and times of <other> (e.g. from a worker) '''
+        for stage in stages:
+            self.times[stage] += other.times[stage]
+        self.files += other.files
+        self.cached += other.cached
+        self.lines += other.lines
+        self.rows += other.rows
+        self.events += other.events
+        for reason, count in other.skipped.iteritems():
+            self.skipped[reason] = self.skipped.get(reason, 0)+count
+    
+    def report(self, outfile=sys.stdout):
+        total = sum(self.times.itervalues())
+        print >>outfile, "Statistics:"
+        for stage in stages:
+            print >>outfile, "  %-8s %9.3f s" % ( stage, self.times[stage] )
+        print >>outfile, "  %-8s %9.3f s" % ( "total", total )
+        ingest = self.times['read']+self.times['parse']
+        print >>outfile, "Read %d lines from %d files (%d cached), " \
+            "stored %d rows" % ( self.lines, self.files, self.cached,
+                                 self.rows )
+        if ingest:
+            print >>outfile, "  %.0f lines/s, %.0f rows/s read and parsed" % \
+                ( self.lines/ingest, self.rows/ingest )
+        if total:
+            print >>outfile, "  %.0f rows/s overall" % ( self.rows/total )
+        rendered = self.times['render']+self.times['write']
+        if rendered:
+            print >>outfile, "Wrote %d events, %.0f events/s" % \
+                ( self.events, self.events/rendered )
+        if self.skipped:
+            print >>outfile, "Skipped lines:"
+            for reason, count in sorted(self.skipped.iteritems()):
+                print >>outfile, "  %8d %s" % ( count, reason )
+
+def timed_lines(infile, stats, sizehint=1<<20):
+    ''' yields the lines of <infile>, adding the time spent reading to the
+    'read' stage of <stats>. Lines are read in batches, so the timing does
+    not cost a clock call for every line. '''
+    
+    while True:
+        start = time.time()
+        batch = infile.readlines(sizehint)
+        stats.times['read'] += time.time()-start
+        if not batch:
+            break
+        for line in batch:
+            yield line
+
 ######## COMMAND LINE / INPUT STUFF ##########
 
-def parse_commandline():
-    usage = "%prog [options]"
+def make_parser():
+    ''' returns the OptionParser for our command line (and for the jobs in
+    a --manifest, which can all be parsed by the same one) '''
+    usage = "%prog [options] [rooster file(s) or directory(s)] [ics file]"
     version = "0.1"
     description = \
         "%prog reads rooster and writes an ICS calendar file for it."
@@ -41,51 +220,289 @@ def parse_commandline():
     parser = OptionParser(usage=usage, description=description,
                           version="%prog "+version, epilog=epilog)
     
-    parser.add_option("-r", "--rooster",   dest="roosterfile", metavar="FILE",
-                      help="rooster file")
-    parser.set_defaults(roosterfile=None)
+    parser.add_option("-r", "--rooster",   dest="roosterfiles", metavar="FILE",
+                      action="append",
+                      help="rooster file or directory of rooster files, "
+                      "may be given more than once ('-' reads from stdin)")
+    parser.set_defaults(roosterfiles=[])
     parser.add_option("-o", "--ics",   dest="icsfile", metavar="FILE",
                       help="ics file")
     parser.set_defaults(icsfile=None)
     parser.add_option("-v", "--verbose", dest="debug", action="store_true",
                      help="Output verbose debugging info (%default)")
     parser.set_defaults(debug=False)
+    parser.add_option("-p", "--progress", dest="progress",
+                      action="store_true",
+                      help="Report each entry while writing (%default)")
+    parser.set_defaults(progress=False)
+    parser.add_option("-s", "--stats", dest="stats", action="store_true",
+                      help="Report time per stage, and why lines were "
+                      "skipped (%default)")
+    parser.set_defaults(stats=False)
+    parser.add_option("-u", "--update", dest="update", action="store_true",
+                      help="Update existing ics file, only rendering events "
+                      "that changed (%default)")
+    parser.set_defaults(update=False)
+    parser.add_option("-f", "--format", dest="formats", action="append",
+                      choices=[ 'ics' ]+list(emitter_formats),
+                      metavar="FORMAT",
+                      help="output format, one of: ics, %s; may be given "
+                      "more than once to write several, next to the ics "
+                      "file (default: ics)" % ", ".join(emitter_formats))
+    parser.set_defaults(formats=[])
+    parser.add_option("-c", "--conflicts", dest="conflicts",
+                      choices=[ 'csv', 'json' ], metavar="FORMAT",
+                      help="also report rooms and lecturers booked twice at "
+                      "the same time, next to the ics file, as csv or json")
+    parser.set_defaults(conflicts=None)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", metavar="N",
+                      help="number of input files to read in parallel "
+                      "(%default)")
+    parser.set_defaults(jobs=multiprocessing.cpu_count())
+    
+    parser.add_option("-x", "--external", dest="external",
+                      action="store_true",
+                      help="remove duplicates on disk instead of in memory, "
+                      "for very large inputs (%default)")
+    parser.set_defaults(external=False)
+    parser.add_option("--tmp-dir", dest="tmpdir", metavar="DIR",
+                      help="directory for the --external database (default: "
+                      "the system's temporary directory)")
+    parser.set_defaults(tmpdir=None)
+    parser.add_option("--no-compact", dest="compact", action="store_false",
+                      help="write an event for each row, instead of merging "
+                      "rows that only differ in their weeks into as few "
+                      "recurring events as possible")
+    parser.set_defaults(compact=True)
+    parser.add_option("-m", "--manifest", dest="manifest", metavar="FILE",
+                      help="run all jobs listed in FILE (JSON or TSV, see "
+                      "read_manifest) in one go, instead of converting the "
+                      "rooster files given")
+    parser.set_defaults(manifest=None)
+    
+    group = OptionGroup(parser, "Cache options",
+                        "Entries read from a rooster file are cached, so "
+                        "unchanged rooster files need not be read again.")
+    group.add_option("--no-cache", dest="cache", action="store_false",
+                     help="do not use the cache")
+    parser.set_defaults(cache=True)
+    group.add_option("--cache-dir", dest="cachedir", metavar="DIR",
+                     help="cache directory (%default)")
+    parser.set_defaults(cachedir=os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "rooster2ics"))
+    group.add_option("--cache-size", dest="cachesize", type="int",
+                     metavar="MB",
+                     help="maximum size of the cache in MB (%default)")
+    parser.set_defaults(cachesize=64)
+    parser.add_option_group(group)
+    
+    group = OptionGroup(parser, "Filter options",
+                        "Only write the events matching all of these; "
+                        "options given more than once match any of their "
+                        "values.")
+    group.add_option("--course", dest="course", action="append",
+                     metavar="CODE",
+                     help="course code, or the start of it (like X_40)")
+    group.add_option("--group", dest="group", action="append",
+                     metavar="GROUP", help="group, like 'Groep A'")
+    group.add_option("--docent", dest="docent", action="append",
+                     metavar="NAME", help="lecturer")
+    group.add_option("--room", dest="room", action="append",
+                     metavar="ROOM", help="room")
+    group.add_option("--type", dest="type", action="append",
+                     metavar="TYPE", help="type, like HC, WC or PR")
+    parser.set_defaults(course=[], group=[], docent=[], room=[], type=[])
+    group.add_option("--from", dest="start", metavar="YYYY-MM-DD",
+                     help="events with occurrences from this date")
+    group.add_option("--until", dest="end", metavar="YYYY-MM-DD",
+                     help="events with occurrences up to this date")
+    parser.set_defaults(start=None, end=None)
+    parser.add_option_group(group)
+    
+    group = OptionGroup(parser, "Split options",
+                        "Besides the ics file, write a calendar for each "
+                        "course, group, etc., in the same pass.")
+    group.add_option("--split", dest="split", action="append",
+                     metavar="KEY",
+                     help="write a calendar for each value of KEY, one of: "
+                     "%s, or several joined by '+' (like Vakcode+Type); "
+                     "may be given more than once" % ", ".join(shard_fields))
+    parser.set_defaults(split=[])
+    group.add_option("--split-dir", dest="splitdir", metavar="DIR",
+                     help="directory for the split calendars (default: the "
+                     "ics file without .ics)")
+    parser.set_defaults(splitdir=None)
+    group.add_option("--max-open", dest="maxopen", type="int", metavar="N",
+                     help="maximum number of split calendars open at a time "
+                     "(%default)")
+    parser.set_defaults(maxopen=64)
+    parser.add_option_group(group)
+    
+    group = OptionGroup(parser, "Watch options",
+                        "With --watch, the ics file is written again "
+                        "whenever rooster files change (or are added to "
+                        "or removed from an input directory); only the "
+                        "changed files are read again.")
+    group.add_option("-w", "--watch", dest="watch", action="store_true",
+                     help="keep watching the rooster files (%default)")
+    parser.set_defaults(watch=False)
+    group.add_option("--interval", dest="interval", type="float",
+                     metavar="SECONDS",
+                     help="how often to look for changes, if inotify is "
+                     "not available (%default)")
+    parser.set_defaults(interval=1.)
+    group.add_option("--debounce", dest="debounce", type="float",
+                     metavar="SECONDS",
+                     help="how long the rooster files should stay "
+                     "unchanged before converting them (%default)")
+    parser.set_defaults(debounce=1.)
+    parser.add_option_group(group)
+    return parser
+
+def parse_commandline(argv=None, parser=None):
+    ''' parses and checks the command line <argv> (default sys.argv), with
+    <parser> if given (see make_parser); exits with an error message if
+    it does not make sense '''
+    if parser is None:
+        parser = make_parser()
 
-    # get the options:
-    (options, args) = parser.parse_args()
+    # get the options, on a copy of the defaults: the lists given more
+    # than once (like --rooster) are appended to, and the parser may be
+    # used again:
+    (options, args) = parser.parse_args(
+        argv, copy.deepcopy(parser.get_default_values()))
     
-    # if we have an option left, use it as rooster file if we don't have that
-    if len(args) and options.roosterfile==None:
-        options.roosterfile = args.pop(0)
-    # if we still have an option left, use as ics file if we don't have that
-    if len(args) and options.icsfile==None:
-        options.icsfile = args.pop(0)
+    # a batch of jobs, which are checked when they run:
+    if options.manifest:
+        if args or options.roosterfiles or options.icsfile:
+            print "ERROR: --manifest can not be combined with input or " \
+                "output files"
+            sys.exit(-1)
+        if options.watch:
+            print "ERROR: --manifest can not be combined with --watch"
+            sys.exit(-1)
+        if not os.path.isfile(options.manifest):
+            print "ERROR: manifest not found:", options.manifest
+            sys.exit(-1)
+        return options, args, parser.get_version()
     
-    # check if we have an option left (which we shouldn't):
-    if len(args):
+    # the last argument is the ics file if we don't have that, and it looks
+    # like one (or, after a single rooster file, does not exist yet, so it
+    # can't be a rooster file; after more, it is more likely a mistyped one):
+    given = len(args)+len(options.roosterfiles)
+    if len(args) and options.icsfile==None and given>1 and \
+            ( args[-1].endswith(".ics") or
+              ( given==2 and not os.path.exists(args[-1]) ) ):
+        options.icsfile = args.pop()
+    # any other arguments are rooster files (or directories):
+    options.roosterfiles += args
+    
+    # check if we have rooster file(s):
+    if not options.roosterfiles:
         parser.print_help()
         print ""
-        print "ERROR: too many argument, or unknown option(s)"
-        print args
+        print "ERROR: no input file given"
         sys.exit(-1)
-
-    # check if we have rooster file:
-    if options.roosterfile == None:
+    if '-' in options.roosterfiles and len(options.roosterfiles)>1:
         parser.print_help()
         print ""
-        print "ERROR: no input file given"
+        print "ERROR: input from stdin can not be combined with input files"
+        sys.exit(-1)
+    if options.watch and options.external:
+        print "ERROR: --external can not be combined with --watch"
+        sys.exit(-1)
+    if options.watch and '-' in options.roosterfiles:
+        print "ERROR: input from stdin can not be watched"
+        sys.exit(-1)
+    # expand directories into the (sorted) rooster files they contain,
+    # keeping the names as given for --watch to look at again:
+    options.inputs = list(options.roosterfiles)
+    options.roosterfiles = expand_roosterfiles(options.roosterfiles)
+    if not options.roosterfiles:
+        print "ERROR: no rooster files found in input directory(s)"
+        sys.exit(-1)
+    # check they all exist:
+    for roosterfile in options.roosterfiles:
+        if roosterfile != '-' and not os.path.isfile(roosterfile):
+            print "ERROR: input file not found:", roosterfile
+            sys.exit(-1)
+    if options.jobs < 1:
+        print "ERROR: number of jobs should be at least 1"
+        sys.exit(-1)
+    if options.cachesize < 0:
+        print "ERROR: cache size can not be negative"
+        sys.exit(-1)
+    try:
+        options.split = [ parse_shard_key(key) for key in options.split ]
+    except ValueError, e:
+        print "ERROR: can not split by", e
+        sys.exit(-1)
+    try:
+        for name in [ 'start', 'end' ]:
+            if getattr(options, name):
+                setattr(options, name, datetime.datetime.strptime(
+                    getattr(options, name), "%Y-%m-%d").date())
+    except ValueError, e:
+        print "ERROR: date not like YYYY-MM-DD:", e
+        sys.exit(-1)
+    # arguments for EntryIndex.select, if there are any:
+    options.filters = dict( ( name, getattr(options, name) ) for name in
+                            [ 'course', 'group', 'docent', 'room', 'type',
+                              'start', 'end' ]
+                            if getattr(options, name) )
+    if options.maxopen < 1:
+        print "ERROR: need to be able to open at least one split calendar"
+        sys.exit(-1)
+    if options.interval <= 0 or options.debounce < 0:
+        print "ERROR: watch interval should be positive, and debounce time " \
+            "not negative"
         sys.exit(-1)
         
     # check if we have ics file:
     if options.icsfile == None:
+        if options.roosterfiles == ['-']:
+            parser.print_help()
+            print ""
+            print "ERROR: no output file given for input from stdin"
+            sys.exit(-1)
+        if len(options.roosterfiles)>1:
+            parser.print_help()
+            print ""
+            print "ERROR: no output file given for multiple input files"
+            sys.exit(-1)
         # create one from roosterfile name:
-        filename, extension = os.path.splitext(options.roosterfile)
+        filename, extension = os.path.splitext(options.roosterfiles[0])
         options.icsfile = filename+".ics"
         print "No output file given, writing output to:", options.icsfile
-        if os.path.isfile(options.icsfile):
+        if os.path.isfile(options.icsfile) and not options.update:
             print "ERROR: output file exists; specify explicitly to overwrite."
             sys.exit(-1)
         
+    # other formats go next to the ics file:
+    if not options.formats:
+        options.formats = [ 'ics' ]
+    options.outfiles = OrderedDict(
+        ( format, "%s.%s" % ( os.path.splitext(options.icsfile)[0], format ) )
+        for format in options.formats if format != 'ics' )
+    options.conflictsfile = None
+    if options.conflicts:
+        options.conflictsfile = "%s.conflicts.%s" % \
+            ( os.path.splitext(options.icsfile)[0], options.conflicts )
+    if options.split and options.splitdir == None:
+        options.splitdir = os.path.splitext(options.icsfile)[0]
+        if options.splitdir == options.icsfile:
+            options.splitdir += ".d"
+    # our outputs may be in an input directory, but are no rooster files:
+    options.outputs = [ options.icsfile ]+options.outfiles.values()
+    if options.conflicts:
+        options.outputs.append(options.conflictsfile)
+    options.roosterfiles = expand_roosterfiles(options.inputs,
+                                               options.outputs)
+    if not options.roosterfiles:
+        print "ERROR: no rooster files found in input directory(s)"
+        sys.exit(-1)
+    
     # we also want to return our version, for use in other output
     version=parser.get_version()
 
@@ -93,119 +510,724 @@ def parse_commandline():
     del(parser)
     return options, args, version
 
-def read_vu_rooster(lines):
+# suffixes of what we write, which is never a rooster file: calendars,
+# the other formats and conflict reports (see parse_commandline), and
+# files being written (see AtomicFile):
+output_suffixes = ( '.ics', '.csv', '.json', '.jsonl', '.tmp' )
+
+def expand_roosterfiles(names, exclude=()):
+    ''' replaces directories in <names> by the rooster files in them, in
+    sorted order; hidden files, files with one of the output_suffixes
+    (whichever run wrote them) and the files in <exclude> (like our own
+    outputs) are skipped in directories '''
+    
+    exclude = set( os.path.abspath(path) for path in exclude )
+    roosterfiles=[]
+    for name in names:
+        if name != '-' and os.path.isdir(name):
+            for filename in sorted(os.listdir(name)):
+                path = os.path.join(name, filename)
+                if filename.startswith('.') or \
+                   filename.endswith(output_suffixes) or \
+                   os.path.abspath(path) in exclude or \
+                   not os.path.isfile(path):
+                    continue
+                roosterfiles.append(path)
+        else:
+            roosterfiles.append(name)
+    return roosterfiles
+
+def last_modified(roosterfiles):
+    ''' returns the time (a datetime) the newest of <roosterfiles> was
+    changed, or None for stdin: the reference to convert at, so the same
+    rooster files always give the same calendar (DTSTAMP included) '''
+    
+    if '-' in roosterfiles or not roosterfiles:
+        return None
+    return datetime.datetime.fromtimestamp(
+        max(os.path.getmtime(roosterfile) for roosterfile in roosterfiles))
+
+def row_schema(with_status, with_weekday, with_group):
+    ''' returns the compiled format checks for rows of one header layout,
+    as a list of ( column, word index, pattern, match ) tuples. Columns
+    count in the full 14 column record, word indices in the row as read
+    (before any missing columns are inserted). Columns that are free text,
+    or that are filled in by us rather than read, are not checked. '''
+    
+    layout = (with_status, with_weekday, with_group)
+    try:
+        return _row_schemas[layout]
+    except KeyError:
+        pass
+    # find out where each column of the full record sits in the row:
+    index = range(len(column_patterns))
+    if not with_status: index.insert(0, None)
+    if with_weekday:    index.insert(weekdaycol, None)
+    if not with_group:  index.insert(groupcol, None)
+    schema = []
+    for column, pattern in enumerate(column_patterns):
+        if pattern and index[column] is not None:
+            schema.append( ( column, index[column], pattern,
+                             re.compile(pattern).match ) )
+    _row_schemas[layout] = schema
+    return schema
+
+def read_vu_rooster(lines, stats=None, log=None, layout=None):
     ''' does the heavy lifting of deciphering the idiosyncratic VU
-    formatted schedule (rooster) table. '''
+    formatted schedule (rooster) table.
+
+    <lines> can be any iterable of lines (an open file, sys.stdin, a
+    generator), or a single string holding the whole table. Entries are
+    yielded one by one as soon as their line has been read, so the input
+    never has to be held in memory in full. Lines that are skipped are
+    counted by reason in <stats> (a Stats), if given. If a <log> function
+    is given, each step is reported to it in detail. If the <layout> is
+    known (see sniff_layout) to be 'table', lines are not checked for
+    being weekday lines or repeated headers. Use read_rooster to read
+    input in any layout. '''
     
     # constants:
-    weekdays = [ 'maandag', 'dinsdag', 'woensdag', 'donderdag', 'vrijdag',
-                 'monday', 'tuesday', 'wednesday', 'thursday', 'friday' ]
-    # which column to look for day of week (optional):
-    weekdaycol = 2
-    # how to recognize times and dates:
-    time_pattern = '[0-9][0-9]*:[0-9][0-9]'
-    date_pattern = '[0-9][0-9]*/[0-9][0-9]*/[0-9][0-9]'
-    # format checking for each column:
-    patterns = [ '',		# status (usually empty)
-                 '[A-Z0-9_]*',	# course code X_405052
-                 '([A-Z]|)[a-z][a-z]', # weekday, like 'di' or 'Tue' (opt.)
-                 date_pattern,	# date 3/9/13
-                 '[0-9, -]*',	# week numbers 36-42, 44
-                 time_pattern,	# start time 13:30
-                 time_pattern,	# end time 15:15
-                 '',		# course name free text
-                 '',		# description free text
-                 '',            # groups free text (optional)
-                 '[A-Z][A-Z]']	# type, like HC, WC, PR
-
-    entries=[]
-    # split into lines
-    week_lines = lines.split('\n')
-    if debug: print "week_lines", len(week_lines)
+    weekdays = weekday_names
+    # check for logging once, not for every line:
+    verbose = log is not None
+    # only rows below weekday lines have those, and headers between them:
+    check_weekdays = layout != 'table'
+
+    # accept a whole table as one string as well:
+    if isinstance(lines, basestring):
+        lines = lines.splitlines(True)
     # first skip till we find a proper header line:
     header_found=False
     have_weekday_line=False
-    for week_line in week_lines:
+    # format checks for the current layout, looked up at the first row:
+    schema=None
+    for week_line in lines:
+        if stats: stats.lines += 1
+        # lines from a file still hold their line ending:
+        week_line = week_line.rstrip('\r\n')
         # look for weekday lines:
-        word = week_line.strip().lower()
-        if word in weekdays:
+        if check_weekdays:
+            word = week_line.strip().lower()
+        else:
+            word = week_line.strip()
+        if not word:
+            if verbose: log("SKIPPING (empty line)")
+            if stats: stats.skip("empty line")
+            continue
+        if check_weekdays and word in weekdays:
             weekday = word
             have_weekday_line = True
-            if debug: print "Weekday line found:", weekday
+            schema = None
+            if verbose: log("Weekday line found: "+weekday)
+            if stats: stats.skip("weekday line")
+            continue
         if not header_found:
             # check for column header line at start
             # Vakcode 	Dag 	Begindatum 	\
             # Kal.wkn 	Start 	Einde 	Vaknaam 	Beschrijving 	\
             # Type 	Zalen 	Docent 	Opmerking
             headers = week_line.split()
-            try:
-                first = headers[0].strip()
-            except IndexError:
-                if debug: print "SKIPPING (empty line)"
-                continue
+            first = headers[0].strip()
             if first in ["Status", "Vakcode"]:
-                if debug: 
-                    print "Header line found:"
-                    print week_line
+                if verbose: log("Header line found:\n"+week_line)
                 header_found=True
                 header_with_status = ( first=="Status" )
                 if not header_with_status: headers.insert(0, '')
                 if have_weekday_line: headers.insert(weekdaycol, "Dag")
                 header_with_group = ( headers[groupcol]=="Groep" )
                 if not header_with_group: headers.insert(groupcol, "Groep")
-                if debug: print "header_with_group", header_with_group
+                if verbose: log("header_with_group %s" % header_with_group)
+                if stats: stats.skip("header line")
                 continue
             else:
-                if debug: print "Header line not yet found"
+                if verbose: log("Header line not yet found")
+                if stats: stats.skip("before header")
                 # skip to next line
                 continue
         
-        if debug: print "READING", week_line
-        # now split on tabs, and strip whitespace,
-        # catching and silently ignoring any failures (empty records)
-        try:
-            words=[ w.strip() for w in week_line.split('\t') ]
-        except AttributeError:
-            if debug: print "SKIPPING (could not get words)"
+        # the header may be repeated (like under each weekday line):
+        if check_weekdays and word.startswith(( "status", "vakcode" )) and \
+           word.split(None, 1)[0] in ( "status", "vakcode" ):
+            if verbose: log("SKIPPING (header line)")
+            if stats: stats.skip("header line")
             continue
+        # now split on tabs, and strip whitespace:
+        words=[ w.strip() for w in week_line.split('\t') ]
         # ignore records with too few entries:
         if len(words)<11:
-            if debug: print "SKIPPING (too few entries)"
+            if verbose: log("SKIPPING (too few entries): "+week_line)
+            if stats: stats.skip("too few fields")
             continue
-        # add status column if it wasn't there:
+        # check contents, stopping at the first column that does not fit:
+        if schema is None:
+            schema = row_schema(header_with_status, have_weekday_line,
+                                header_with_group)
+            if verbose:
+                log("Layout: status column %s, weekday column %s, "
+                    "group column %s" % ( header_with_status,
+                                          have_weekday_line,
+                                          header_with_group ))
+        error = None
+        for column, i, pattern, match in schema:
+            if not match(words[i]):
+                error = column, i, pattern
+                break
+        if error: # skip this line, and continue with next
+            column, i, pattern = error
+            if verbose:
+                log("FORMAT ERROR: %s %s not conform %s" % \
+                    ( column_names[column], words[i], pattern ))
+                log("SKIPPING (format errors)")
+            if stats: stats.skip("format error: "+column_names[column])
+            continue
+        # add status, weekday and group columns if they weren't there:
         if not header_with_status:
-            if debug: print "Adding empty status column"
             words.insert(0, '')
         if have_weekday_line:
-            if debug: print "Adding weekday column (%d): %s" % \
-               ( weekdaycol, weekday )
             words.insert(weekdaycol, weekday)
         if not header_with_group:
-            if debug: print "Adding empty group column (%d)" % groupcol
             words.insert(groupcol, '')
-        # check contents:
-        im = min(len(patterns), len(words))
-        error = False
-        for i in range(im):
-            if debug:
-                print i, headers[i], patterns[i], words[i]
-            if not re.match(patterns[i], words[i]):
-                if debug:
-                    print "FORMAT ERROR:", headers[i], words[i], \
-                        "not conform", patterns[i]
-                error=True
-        if error: # skip this line, and continue with next
-            if debug: print "SKIPPING (format errors)"
-            continue
         # now store 
-        if debug: print "STORING", words
-        # pad words with None's, and return a tuple of exactly 14
-        # (so we always know to unpack it into 14 variables):
-        entries.append( tuple(words+[None,None,None,None,None,
-                                     None,None,None,None,None,
-                                     None,None])[:14] )
+        if verbose: log("STORING %s" % words)
+        try:
+            entry = make_entry(words)
+        except ValueError, e:
+            if verbose: log("SKIPPING (unparseable %s: %s)" % e.args)
+            if stats: stats.skip("format error: "+e.args[0])
+            continue
+        if stats: stats.rows += 1
+        yield entry
+
+def make_entry(words):
+    ''' turns the (at least 11) <words> of a complete row into an Entry,
+    parsing dates, times and weeks; raises ValueError( column name, word )
+    if they don't parse '''
+    
+    # pad words with empty strings, to get exactly 14:
+    words = words+['']*(14-len(words))
+    ( Status, Vakcode, Dag, Begindatum, Weken, Start, Einde, Vaknaam,
+      Beschrijving, Groep, Type, Zalen, Docent, Opmerking ) = words[:14]
+    date = date2ymd(Begindatum)
+    if date == -1:
+        raise ValueError("Begindatum", Begindatum)
+    # dates like 31/2/17 have the right form, but are no date:
+    try:
+        datetime.date(*date)
+    except ValueError:
+        raise ValueError("Begindatum", Begindatum)
+    start, end = time2minutes(Start), time2minutes(Einde)
+    if start == -1:
+        raise ValueError("Start", Start)
+    if end == -1:
+        raise ValueError("Einde", Einde)
+    try:
+        weken = weeks2list(Weken, date[0])
+    except ValueError:
+        raise ValueError("Kal.wkn", Weken)
+    # fields that repeat a lot are interned, to share the strings:
+    return Entry(intern(Status), intern(Vakcode), day2day(Dag), date,
+                 weken, start, end, intern(Vaknaam), Beschrijving,
+                 intern(Groep), intern(Type), intern(Zalen), intern(Docent),
+                 Opmerking)
+
+######## HTML INPUT ##########
+
+class RoosterHTMLParser(HTMLParser):
+    ''' turns a saved or downloaded rooster page into the lines that
+    read_vu_rooster reads from a pasted one: each table row becomes a line
+    of tab separated cells, and text outside tables (like the weekday
+    above each table) a line of its own. No document tree is built; the
+    lines pile up in <lines> as the page is fed in, and can be taken out
+    after every feed. '''
+
+    # tags that end a line of text outside tables:
+    block_tags = set([ 'p', 'div', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+                       'li', 'ul', 'ol', 'title', 'caption', 'table' ])
+    # tags whose contents are not text:
+    skip_tags = set([ 'script', 'style', 'head' ])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.lines = []
+        # text outside cells, for the current line:
+        self.text = []
+        # cells of the current row, and text of the current cell:
+        self.cells = None
+        self.cell = None
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skipping += 1
+        elif tag == 'tr':
+            self.end_row()
+            self.end_text()
+            self.cells = []
+        elif tag in ( 'td', 'th' ):
+            # end tags of cells (and rows) may be left out:
+            self.end_cell()
+            if self.cells is None:
+                self.end_text()
+                self.cells = []
+            self.cell = []
+        elif tag in self.block_tags:
+            self.end_block()
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags:
+            self.skipping = max(self.skipping-1, 0)
+        elif tag in ( 'td', 'th' ):
+            self.end_cell()
+        elif tag in ( 'tr', 'table' ):
+            self.end_row()
+        elif tag in self.block_tags:
+            self.end_block()
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.cell is not None:
+            self.cell.append(data)
+        else:
+            self.text.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(self.entity(name2codepoint[name]))
+        else:
+            self.handle_data('&'+name+';')
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in 'xX':
+                self.handle_data(self.entity(int(name[1:], 16)))
+            else:
+                self.handle_data(self.entity(int(name)))
+        except ValueError:
+            self.handle_data('&#'+name+';')
+
+    def entity(self, codepoint):
+        ''' returns the text of a character reference, in UTF-8 '''
+        if codepoint == 0xa0: # no need to keep a non-breaking space
+            return ' '
+        return unichr(codepoint).encode('utf-8')
+
+    def end_block(self):
+        if self.cell is not None:
+            self.cell.append(' ')
+        else:
+            self.end_text()
+
+    def end_text(self):
+        text = ' '.join(''.join(self.text).split())
+        if text:
+            self.lines.append(text)
+        self.text = []
+
+    def end_cell(self):
+        if self.cell is not None:
+            # tabs and newlines in a cell would break up the row:
+            self.cells.append(' '.join(''.join(self.cell).split()))
+            self.cell = None
+
+    def end_row(self):
+        self.end_cell()
+        if self.cells:
+            self.lines.append('\t'.join(self.cells))
+        self.cells = None
+
+    def close(self):
+        HTMLParser.close(self)
+        self.end_row()
+        self.end_text()
+
+def sniff_html(lines):
+    ''' peeks at the first text in <lines>, and returns ( lines, is_html ),
+    with the lines still complete and is_html telling whether the first
+    text is markup rather than a pasted rooster '''
+
+    lines = iter(lines)
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip():
+            break
+    is_html = bool(head) and \
+        head[-1].lstrip().lstrip('\xef\xbb\xbf').startswith('<')
+    return itertools.chain(head, lines), is_html
+
+def html_lines(chunks):
+    ''' yields the rooster lines of the HTML page coming in as <chunks>
+    (lines, or pieces of any size), as soon as each line is complete '''
+
+    parser = RoosterHTMLParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.lines:
+            for line in parser.lines:
+                yield line
+            parser.lines = []
+    parser.close()
+    for line in parser.lines:
+        yield line
+
+def read_v1_rooster(lines, stats=None, log=None):
+    ''' reads the older layout of the rooster.vu.nl export, which
+    rooster2ics_v1.py used to read: tables separated by empty lines, each
+    starting with a line of dates and a header line starting with Status,
+    without a Groep column. A cell (like Docent, holding more than one
+    lecturer) may run over more lines, so a row only ends at the end of
+    the line with its 12th tab, or when the next line starts a row.
+    <lines>, <stats> and <log>, and the entries yielded, are as for
+    read_vu_rooster. '''
+    
+    verbose = log is not None
+    if isinstance(lines, basestring):
+        lines = lines.splitlines(True)
+    
+    def make_row(record):
+        words = [ w.strip() for w in record.split('\t') ]
+        if len(words) not in ( 12, 13 ):
+            if verbose: log("SKIPPING (%d entries): %r" % ( len(words),
+                                                             record ))
+            if stats: stats.skip("too few fields" if len(words) < 12
+                                 else "too many fields")
+            return None
+        # footer lines have neither status nor course code:
+        if words[0] == '' and words[1] == '':
+            if verbose: log("SKIPPING (no course code): %r" % record)
+            if stats: stats.skip("no course code")
+            return None
+        words.insert(groupcol, '')
+        if verbose: log("STORING %s" % words)
+        try:
+            entry = make_entry(words)
+        except ValueError, e:
+            if verbose: log("SKIPPING (unparseable %s: %s)" % e.args)
+            if stats: stats.skip("format error: "+e.args[0])
+            return None
+        if stats: stats.rows += 1
+        return entry
+    
+    # lines into the current table (0 between tables), whether it has its
+    # header, and the row read so far:
+    table_line = 0
+    header_found = False
+    record = None
+    # (None marks the end of the input, which ends the last row too)
+    for line in itertools.chain(lines, [ None ]):
+        if line is not None:
+            if stats: stats.lines += 1
+            line = line.rstrip('\r\n')
+        if record is not None and \
+           ( not line or not line.strip() or
+             ( line.count('\t') >= 11 and record.count('\t') >= 11 ) ):
+            # the row read so far is complete:
+            entry = make_row(record)
+            record = None
+            if entry: yield entry
+        if line is None:
+            break
+        if not line.strip():
+            table_line = 0
+            header_found = False
+            if verbose: log("SKIPPING (empty line)")
+            if stats: stats.skip("empty line")
+            continue
+        table_line += 1
+        if table_line == 1:
+            if verbose: log("Date line found: "+line)
+            if stats: stats.skip("date line")
+            continue
+        if not header_found:
+            if line.split()[0] == "Status":
+                if verbose: log("Header line found:\n"+line)
+                header_found = True
+                if stats: stats.skip("header line")
+            else:
+                if verbose: log("Header line not yet found")
+                if stats: stats.skip("before header")
+            continue
+        if record is None:
+            record = line
+        else:
+            record += '\n'+line
+        if record.count('\t') >= 12:
+            entry = make_row(record)
+            record = None
+            if entry: yield entry
+
+def sniff_layout(lines, sample=200):
+    ''' peeks at the first <sample> lines of a (text) rooster in <lines>,
+    and returns ( lines, layout ), with the lines still complete and layout
+    one of rooster_parsers: 'v1' for the older export (a Status header
+    without Groep, below a line of dates), 'weekday' if the rows of each
+    day are below a weekday line, or 'table' otherwise '''
+
+    lines = iter(lines)
+    head = list(itertools.islice(lines, sample))
+    layout = 'table'
+    previous = ''
+    for line in head:
+        line = line.strip()
+        if not line:
+            continue
+        if line.lower() in weekday_names:
+            layout = 'weekday'
+            break
+        words = line.split()
+        if words[0] == "Status" and "Groep" not in words and \
+           re.match(v1_date_pattern, previous):
+            layout = 'v1'
+            break
+        previous = line
+    return itertools.chain(head, lines), layout
+
+def read_table_rooster(lines, stats=None, log=None):
+    ''' read_vu_rooster for a single table, without weekday lines '''
+    return read_vu_rooster(lines, stats, log, 'table')
+
+def read_weekday_rooster(lines, stats=None, log=None):
+    ''' read_vu_rooster for rows below weekday lines '''
+    return read_vu_rooster(lines, stats, log, 'weekday')
+
+# parser for each layout sniff_layout finds:
+rooster_parsers = { 'v1': read_v1_rooster,
+                    'weekday': read_weekday_rooster,
+                    'table': read_table_rooster }
+
+def read_rooster(lines, stats=None, log=None):
+    ''' reads the entries from a rooster in any of the known layouts: a
+    pasted table (see read_vu_rooster), an older export (see
+    read_v1_rooster), or a saved or downloaded HTML page of either (see
+    RoosterHTMLParser). The layout is sniffed from the start of <lines>;
+    <lines>, <stats> and <log>, and the entries yielded, are as for
+    read_vu_rooster. '''
+
+    if isinstance(lines, basestring):
+        lines = lines.splitlines(True)
+    lines, is_html = sniff_html(lines)
+    if is_html:
+        if log: log("HTML input found")
+        lines = html_lines(lines)
+    lines, layout = sniff_layout(lines)
+    if log: log("Layout found: "+layout)
+    return rooster_parsers[layout](lines, stats, log)
+
+class EntryCache(object):
+    ''' on-disk cache of the entries read from rooster files. Entries are
+    stored under a hash of the file contents and the parser version, so
+    a changed file (or parser) simply misses. When the cache grows beyond
+    <maxsize> bytes, the least recently used files are removed. Warnings
+    and (if <verbose>) removals are reported to <log>, if given. '''
+    
+    def __init__(self, cachedir, maxsize=64<<20, log=None, verbose=False):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.log = log
+        self.verbose = verbose
+    
+    def key(self, roosterfile):
+        ''' returns the cache key for the contents of <roosterfile> '''
+        digest = hashlib.sha1("rooster2ics parser %d\n" % parser_version)
+        infile = open(roosterfile, 'rb')
+        try:
+            for chunk in iter(lambda: infile.read(1<<20), ''):
+                digest.update(chunk)
+        finally:
+            infile.close()
+        return digest.hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.cachedir, key+".pickle")
+    
+    def get(self, key):
+        ''' returns the cached entries for <key>, or None '''
+        path = self.path(key)
+        try:
+            infile = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                entries = [ Entry._make(entry) for entry in pickle.load(infile) ]
+            except Exception:
+                # broken (e.g. half written by a crashed run); ignore it:
+                return None
+        finally:
+            infile.close()
+        # mark as recently used:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entries
+    
+    def put(self, key, entries):
+        ''' stores <entries> under <key>, and trims the cache to size '''
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            # write to a temporary file first, so readers never see
+            # a partial file:
+            fd, tmppath = tempfile.mkstemp(dir=self.cachedir, suffix=".tmp")
+            outfile = os.fdopen(fd, 'wb')
+            try:
+                # as plain tuples, so they load whatever module Entry is in:
+                pickle.dump([ tuple(entry) for entry in entries ], outfile,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                outfile.close()
+            os.rename(tmppath, self.path(key))
+        except (IOError, OSError), e:
+            if self.log: self.log("WARNING: could not write cache: %s" % e)
+            return
+        self.evict()
+    
+    def evict(self):
+        ''' removes least recently used entries until the cache fits '''
+        files = []
+        total = 0
+        for filename in os.listdir(self.cachedir):
+            if not filename.endswith(".pickle"):
+                continue
+            path = os.path.join(self.cachedir, filename)
+            try:
+                st = os.stat(path)
+            except OSError: # removed by another process
+                continue
+            files.append( (st.st_mtime, st.st_size, path) )
+            total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.maxsize:
+                break
+            if self.verbose and self.log:
+                self.log("Removing from cache: "+path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def read_rooster_file(roosterfile, cache=None, stats=None, log=None):
+    ''' reads all entries from one rooster file ('-' reads from stdin),
+    using <cache> (an EntryCache) if given, and timing the read and parse
+    stages in <stats> (a Stats) if given; <log> is as for read_rooster '''
+    
+    if stats:
+        stats.files += 1
+        start = time.time()
+        read_before = stats.times['read']
+    if roosterfile == '-':
+        infile = sys.stdin
+    else:
+        if cache:
+            key = cache.key(roosterfile)
+            entries = cache.get(key)
+            # hashing and loading from the cache count as reading:
+            if stats: stats.times['read'] += time.time()-start
+            if entries is not None:
+                if log: log("Using cached entries for "+roosterfile)
+                if stats:
+                    stats.cached += 1
+                    stats.rows += len(entries)
+                return entries
+        infile = open(roosterfile)
+    try:
+        if stats:
+            lines = timed_lines(infile, stats)
+        else:
+            lines = infile
+        entries = list(read_rooster(lines, stats, log))
+    finally:
+        if infile is not sys.stdin: infile.close()
+    if stats:
+        # the time not spent reading is parsing:
+        stats.times['parse'] += time.time()-start - \
+            ( stats.times['read']-read_before )
+    if cache and roosterfile != '-':
+        cache.put(key, entries)
+    return entries
+
+def _read_rooster_job(args):
+    ''' read_rooster_file for pool workers, taking its arguments as one, and
+    returning the entries with the worker's own Stats (or None) '''
+    roosterfile, cache, with_stats, log = args
+    stats = with_stats and Stats() or None
+    return read_rooster_file(roosterfile, cache, stats, log), stats
+
+def iter_rooster_files(roosterfiles, jobs=1, cache=None, stats=None,
+                       log=None):
+    ''' yields the entries of each of <roosterfiles> in turn, as a list per
+    file, reading them with a pool of <jobs> worker processes, <cache> (an
+    EntryCache) and <stats> (a Stats) if given. Files are yielded in the
+    order of <roosterfiles>, whichever worker finishes first, and only a
+    few are held at a time. With more than one job, the read and parse
+    times in <stats> are summed over the workers, and <log> (as for
+    read_vu_rooster) has to be a module level function, like print_log. '''
+    
+    jobs = min(jobs, len(roosterfiles))
+    if jobs <= 1:
+        per_file = ( read_rooster_file(f, cache, stats, log)
+                     for f in roosterfiles )
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(_read_rooster_job,
+                            [ (f, cache, bool(stats), log)
+                              for f in roosterfiles ],
+                            chunksize=1)
+        def collect():
+            try:
+                for file_entries, file_stats in results:
+                    if stats: stats.add(file_stats)
+                    yield file_entries
+            finally:
+                pool.terminate()
+        per_file = collect()
+    # the results first, so the pool is shut down once they run out:
+    for file_entries, roosterfile in itertools.izip(per_file, roosterfiles):
+        if log: log("Read %d entries from %s" % ( len(file_entries),
+                                                  roosterfile ))
+        yield file_entries
+
+def read_rooster_files(roosterfiles, jobs=1, cache=None, stats=None,
+                       log=None, separate=False):
+    ''' reads entries from several rooster files, as for
+    iter_rooster_files, and returns them all in one list; with
+    <separate>, as a list of the entries of each file. '''
+    
+    per_file = iter_rooster_files(roosterfiles, jobs, cache, stats, log)
+    if separate:
+        return list(per_file)
+    entries = []
+    for file_entries in per_file:
+        entries.extend(file_entries)
     return entries
 
+######## DATES AND TIMES ##########
+
+def memoized(maxsize=4096):
+    ''' decorator that remembers the results of a function of hashable
+    arguments; the memory is cleared when it holds <maxsize> results '''
+    
+    def decorate(function):
+        memory={}
+        def memoized_function(*args):
+            try:
+                return memory[args]
+            except KeyError:
+                pass
+            if len(memory) >= maxsize:
+                memory.clear()
+            result = memory[args] = function(*args)
+            return result
+        memoized_function.__name__ = function.__name__
+        memoized_function.__doc__ = function.__doc__
+        return memoized_function
+    return decorate
+
+@memoized()
 def time2minutes(time):
     '''parses time as "13:45" and returns time in minutes of day'''
     
@@ -215,216 +1237,1611 @@ def time2minutes(time):
         return -1
     return h*60+m
 
-def time2hm(time):
-    '''parses time as "13:45" and returns tuple of ( hours, minutes )'''
+def minutes2time(minutes):
+    ''' formats <minutes> of the day as a time like "13:45" '''
     
-    try:
-        h, m= ( int(s) for s in re.split(r'[:.]', time) )
-    except ValueError:
-        return None
-    # tweak time zone:
-    h-=2
-    return h, m
+    return "%02d:%02d" % divmod(minutes, 60)
 
+@memoized()
 def date2ymd(date):
     ''' parses date as "dd/mm/yy" and returns tuple of (YYYY, MM, DD)'''
     try:
         d,m,y = ( int(s) for s in re.split(r'[-/. ]', date) )
     except ValueError:
-        print "Unparseable date:", date
         return -1
     if y<80: c=2000
     else: c=1900
     return ( c+y, m, d )
 
+@memoized()
 def day2day(day):
     ''' translates day of week name into ics standard names'''
     
-    # to convert day names to ics standards
-    ics_day = { 
-        'ma':'MO', 
-        'di':'TU', 
-        'wo':'WE', 
-        'do':'TH', 
-        'vr':'FR', 
-        'za':'SA', 
-        'zo':'SU', 
-        'mo':'MO', 
-        'tu':'TU', 
-        'we':'WE', 
-        'th':'TH', 
-        'fr':'FR', 
-        'sa':'SA', 
-        'su':'SU', 
-    }
-    
     return ics_day.get( day.lower()[:2] )
 
-def write_ical_event(outfile, this_week, this_year, 
-                     Vakcode, Dag, Begindatum, Weken, 
-                     Start, Einde, Vaknaam, Beschrijving, 
-                     Groep, Type, Zalen, Docent, Opmerking):
-    if debug: print "INPUT:", ( Vakcode, Dag, Begindatum, Weken, 
-                                Start, Einde, Vaknaam, Beschrijving, 
-                                Groep, Type, Zalen, Docent, Opmerking )
-    # check for weeks, can be 31-42 or '31-42, 44'
-    if debug: print Weken
-    week_parts = Weken.split(', ')
+@memoized()
+def dst_period(year):
+    ''' returns the start and end of summer time in <year>, as local
+    minutes since 0001-01-01 (see AcademicCalendar.utc_offset): from 02:00
+    on the last Sunday of March, to 03:00 on the last Sunday of October '''
+    
+    start = datetime.date(year, 3, 31).toordinal()
+    start -= datetime.date.fromordinal(start).isoweekday()%7
+    end = datetime.date(year, 10, 31).toordinal()
+    end -= datetime.date.fromordinal(end).isoweekday()%7
+    return start*1440+2*60, end*1440+3*60
+
+@memoized()
+def weeks_in_year(year):
+    ''' returns the number of (ISO) calendar weeks in <year>, 52 or 53 '''
+    
+    return datetime.date(year, 12, 28).isocalendar()[1]
+
+@memoized()
+def weeks2list(Weken, year):
+    ''' expands week numbers like '36-42, 44' (or a range wrapping into the
+    next year, like '50-3') into a tuple of week numbers; <year> is the year
+    the first week is in '''
+    
     weken = []
-    for week_part in week_parts:
-        if debug: print "Part", week_part
+    for week_part in Weken.split(', '):
         try:
             startweek,endweek = ( int(w) for w in week_part.split('-') )
         except ValueError:
             startweek,endweek = int(week_part), int(week_part)
         r=range(startweek, endweek+1)
         if r==[]:
-            r=range(startweek, 52)+range(1,endweek+1)
-        if debug: print "Range:", r
+            r=range(startweek, weeks_in_year(year)+1)+range(1,endweek+1)
         weken += r
+    return tuple(weken)
+
+class AcademicCalendar(object):
+    ''' date and time zone tables for converting a schedule, which runs
+    by academic year (sept-aug): the dates of the events, filled in for
+    the years of the schedule's own dates as they come up. A run's stages
+    share one calendar (academic_calendar), so the dates of each distinct
+    first date and weeks are worked out once; at most <maxsize> are kept. '''
     
-    # get begin/end times
-    start = time2minutes(Start)
-    end   = time2minutes(Einde)
-    if debug: 
-        print "SCHEDULE:", weken, "-", \
-            " %s %s-%s %s" % (Dag,Start,Einde,Zalen)
+    def __init__(self, maxsize=1<<16):
+        self.maxsize = maxsize
+        # ( first, weken ) -> dates:
+        self.dates = {}
     
-    # get correct calendar year (schedule runs by academic year sept-aug)
-    if weken[0] < (52+this_week-10)%52:
-        year = this_year+1
-    else:
-        year = this_year
-    if debug: print "Processing year", year
-    #print Begindatum,startweek,endweek,this_week,year,date2date(Begindatum)
-    #print "date conversion:", Begindatum, date2date(Begindatum), test
-    if debug: print "DATE:", "%04d%02d%02d" % date2ymd(Begindatum)
-    starts = "%04d%02d%02dT%02d%02d00Z" % ( date2ymd(Begindatum)+time2hm(Start) )
-    if debug: print " start", starts
-    ends   = "%04d%02d%02dT%02d%02d00Z" % ( date2ymd(Begindatum)+time2hm(Einde) )
-    if debug: print " end",   ends
-    if debug: print
-    
-    # now write actual event:
-    print >>outfile, "BEGIN:VEVENT"
+    def occurrences(self, first, weken):
+        ''' returns the dates (as ordinals) of an event in each of the
+        weeks in <weken>, the first of which is on date <first> (y, m, d) '''
+        try:
+            return self.dates[first, weken]
+        except KeyError:
+            pass
+        if len(self.dates) >= self.maxsize:
+            self.dates.clear()
+        ordinal = datetime.date(*first).toordinal()
+        # weeks numbered lower than the first one are in the next year:
+        nweeks = weeks_in_year(first[0])
+        dates = self.dates[first, weken] = \
+            tuple( ordinal + 7*( (week-weken[0]) % nweeks ) for week in weken )
+        return dates
+    
+    def utc_offset(self, ordinal, minutes):
+        ''' returns the UTC offset in minutes (60 or 120) of local time
+        <minutes> past midnight on date <ordinal>, in ics_tzid '''
+        local = ordinal*1440+minutes
+        start, end = dst_period(datetime.date.fromordinal(ordinal).year)
+        return 120 if start <= local < end else 60
+    
+    def utc(self, ordinal, minutes):
+        ''' returns local time <minutes> past midnight on date <ordinal> as
+        an ICS UTC date-time, for values that can not carry a TZID (like
+        the UNTIL of an RRULE) '''
+        ordinal, minutes = divmod(ordinal*1440+minutes -
+                                  self.utc_offset(ordinal, minutes), 1440)
+        date = datetime.date.fromordinal(ordinal)
+        return "%04d%02d%02dT%02d%02d00Z" % ( ( date.year, date.month,
+                                                date.day )+
+                                              divmod(minutes, 60) )
+
+# the calendar shared by all stages (see AcademicCalendar):
+academic_calendar = AcademicCalendar()
+
+######## ICS OUTPUT ##########
+
+# characters that need a backslash in ICS text values (RFC 5545, 3.3.11):
+_ics_escapes = re.compile(r'([\\;,])')
+
+def ics_escape(text):
+    ''' escapes <text> for use as an ICS text value '''
+    
+    text = _ics_escapes.sub(r'\\\1', text)
+    return text.replace('\r\n', '\\n').replace('\n', '\\n')
+
+def ics_text(name, text):
+    ''' returns content line for property <name> with text value <text> '''
+    
+    return name+":"+ics_escape(text)
+
+def ics_fold(line, width=75):
+    ''' folds content <line> into lines of at most <width> octets (RFC 5545,
+    3.1), never splitting a UTF-8 encoded character '''
+    
+    if len(line) <= width:
+        return line
+    parts=[]
+    start=0
+    limit=width
+    while len(line)-start > limit:
+        end=start+limit
+        # back up to the first byte of a multi-byte character:
+        while end>start+1 and 0x80 <= ord(line[end]) < 0xC0:
+            end-=1
+        parts.append(line[start:end])
+        start=end
+        # continuation lines start with a space:
+        limit=width-1
+    parts.append(line[start:])
+    return "\r\n ".join(parts)
+
+class IcsWriter(object):
+    ''' buffers rendered calendar text and writes it to <outfile> in chunks
+    of about <bufsize> bytes, instead of one write per content line; the
+    time spent writing is added to <stats> (a Stats) if given '''
+    
+    def __init__(self, outfile, bufsize=1<<16, stats=None):
+        self.outfile = outfile
+        self.bufsize = bufsize
+        self.stats = stats
+        self.buffer = []
+        self.buffered = 0
+    
+    def write(self, text):
+        ''' adds already rendered (folded, CRLF terminated) <text> '''
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.bufsize:
+            self.flush()
+    
+    def write_line(self, line):
+        ''' adds a single content line, folding it if needed '''
+        self.write(ics_fold(line)+"\r\n")
+    
+    def begin_calendar(self, version):
+        self.write_line("BEGIN:VCALENDAR")
+        self.write_line("VERSION:2.0")
+        self.write_line("PRODID:-//rooster2ics//%s//EN" % version)
+        for line in ics_timezone:
+            self.write_line(line)
+    
+    def end_calendar(self):
+        self.write_line("END:VCALENDAR")
+        self.flush()
+    
+    def flush(self):
+        if self.buffer:
+            if self.stats: start = time.time()
+            self.outfile.write("".join(self.buffer))
+            if self.stats: self.stats.times['write'] += time.time()-start
+            self.buffer = []
+            self.buffered = 0
+
+class AtomicFile(object):
+    ''' a file that is written next to <path> under a temporary name, and
+    only replaces <path> on close, so readers (like calendar programs
+    polling a published feed) never see a partly written file '''
+
+    def __init__(self, path):
+        self.path = path
+        fd, self.tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        self.outfile = os.fdopen(fd, 'wb')
+
+    def write(self, text):
+        self.outfile.write(text)
+
+    def close(self):
+        ''' puts the written file in place '''
+        self.outfile.close()
+        # keep the permissions of the file we replace (or the usual
+        # ones for a new file, instead of mkstemp's private ones):
+        try:
+            mode = os.stat(self.path).st_mode & 07777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(self.tmppath, mode)
+        os.rename(self.tmppath, self.path)
+
+    def discard(self):
+        ''' drops the written file, leaving <path> as it was '''
+        self.outfile.close()
+        os.remove(self.tmppath)
+
+def render_ical_event(calendar, entry,
+                      uid=None, fingerprint=None, sequence=0, dtstamp=None,
+                      log=None):
+    ''' renders rooster <entry> as a VEVENT, and returns it as a single
+    string of folded, CRLF terminated content lines. <uid>, <fingerprint>
+    (see event_uid and event_fingerprint), <sequence> and <dtstamp> are
+    written along if given. The details are reported to <log>, if given. '''
+    ( Status, Vakcode, Dag, Begindatum, Weken, Start, Einde, Vaknaam,
+      Beschrijving, Groep, Type, Zalen, Docent, Opmerking ) = entry
+    
+    # local times, in the time zone of the calendar (see ics_timezone):
+    starts = "%04d%02d%02dT%02d%02d00" % ( Begindatum+divmod(Start, 60) )
+    ends   = "%04d%02d%02dT%02d%02d00" % ( Begindatum+divmod(Einde, 60) )
+    if log: 
+        log("INPUT: %s" % ( entry, ))
+        log("SCHEDULE: %s -  %s %d-%d %s" % (Weken,Dag,Start,Einde,Zalen))
+        log("Processing year %d" % Begindatum[0])
+        log("DATE: %04d%02d%02d" % Begindatum)
+        log(" start "+starts)
+        log(" end "+ends)
+        log("")
+    # the weeks skipped between the first and last occurrence:
+    if len(Weken)>1:
+        dates = calendar.occurrences(Begindatum, Weken)
+        skipped = sorted(set(range(dates[0], dates[-1], 7))-set(dates))
+    
+    # now render actual event:
+    event = [ "BEGIN:VEVENT" ]
+    if uid:         event.append( "UID:%s" % uid )
+    if dtstamp:     event.append( "DTSTAMP:%s" % dtstamp )
+    if sequence:    event.append( "SEQUENCE:%d" % sequence )
+    if fingerprint: event.append( "X-ROOSTER2ICS-HASH:%s" % fingerprint )
     if Vaknaam=="":
         Vaknaam = Beschrijving
         Beschrijving = None
-    summary="SUMMARY:%s"  % ( Vaknaam )
+    summary="%s"  % ( Vaknaam )
     if Groep: summary+=" - "+Groep
     summary+=" (%s)"  % ( Type )
-    print >>outfile, summary
-    print >>outfile, "LOCATION:%s" % ( Zalen )
+    event.append( ics_text("SUMMARY", summary) )
+    event.append( ics_text("LOCATION", "%s" % ( Zalen )) )
     descs=[]
     if Vaknaam:      descs.append(Vaknaam)
     if Vakcode:      descs.append("("+Vakcode+")")
     if Beschrijving: descs.append(Beschrijving)
     if Docent:       descs.append(Docent)
     if Opmerking:    descs.append(Opmerking)
-    if len(weken)>1: # multiple and/or complicated week range
-        count = weken[-1] - weken[0] + 1
-        if count != len(weken): # now it's complicated
-            descs.append("Weeknrs: "+str(weken))
+    # (the weeks of a series are in its RRULE and EXDATE)
     if descs:
-	print >>outfile, "DESCRIPTION:%s" %  ( " - ".join(descs) )
-    print >>outfile, "DTSTART:%s" % starts
-    print >>outfile, "DTEND:%s"   % ends
-    if len(weken)>1:
-        count   = weken[-1] - weken[0] + 1
-	print >>outfile, "RRULE:FREQ=WEEKLY;COUNT=%d;INTERVAL=1;BYDAY=%s" % \
-            ( count, day2day(Dag) )
-    print >>outfile, "END:VEVENT"
-
-def make_unique(entries):
-    ''' remove duplicate entries, and collaps ones with different groups'''
-    
-    # first make set (removes duplicates from list):
-    print "Starting with", len(entries), "entries"
-    entries = list(set(entries))
-    print "Now", len(entries), "unique entries"
-
-    # now check without groups:
-    entryd={}
-    order=[]
+	event.append( ics_text("DESCRIPTION", " - ".join(descs)) )
+    event.append( "DTSTART;TZID=%s:%s" % ( ics_tzid, starts ) )
+    event.append( "DTEND;TZID=%s:%s"   % ( ics_tzid, ends ) )
+    if len(Weken)>1:
+        # (UNTIL is in UTC, whatever the time zone of DTSTART)
+        rrule = "RRULE:FREQ=WEEKLY;UNTIL=%s;INTERVAL=1" % \
+            calendar.utc(dates[-1], Start)
+        # without a (known) day, the day of DTSTART is used:
+        if Dag: rrule += ";BYDAY=%s" % Dag
+	event.append( rrule )
+        if skipped:
+            exdates = []
+            for date in skipped:
+                date = datetime.date.fromordinal(date)
+                exdates.append("%04d%02d%02dT%02d%02d00" % \
+                               ( ( date.year, date.month, date.day )+
+                                 divmod(Start, 60) ))
+            event.append( "EXDATE;TZID=%s:%s" % ( ics_tzid,
+                                                 ",".join(exdates) ) )
+    event.append( "END:VEVENT" )
+    return "".join( ics_fold(line)+"\r\n" for line in event )
+
+def event_uid(entry):
+    ''' returns a UID for <entry> that stays the same between runs, made
+    from the fields that identify an event (course code, weekday, start
+    date, times, type and groups) '''
+    
+    key = repr( ( entry.Vakcode, entry.Dag, entry.Begindatum, entry.Start,
+                  entry.Einde, entry.Type, entry.Groep ) )
+    return hashlib.sha1(key).hexdigest()+"@rooster2ics"
+
+def event_fingerprint(entry):
+    ''' returns a hash of all fields of <entry> (and of the render_version),
+    which changes whenever the rendered event would change '''
+    
+    return hashlib.sha1(repr( (render_version,)+tuple(entry) )).hexdigest()
+
+def read_ics_events(infile):
+    ''' reads the VEVENTs written by an earlier run from ICS <infile>, and
+    returns a dict of UID -> ( fingerprint, sequence, rendered text ) '''
+    
+    events={}
+    event=None
+    for line in infile:
+        if event is None:
+            if line.rstrip('\r\n') == "BEGIN:VEVENT":
+                event=[line]
+            continue
+        event.append(line)
+        if line.rstrip('\r\n') != "END:VEVENT":
+            continue
+        # look up the properties we need, in the unfolded event:
+        text="".join(event)
+        properties={}
+        for content in text.replace("\r\n ", "").split("\r\n"):
+            name, sep, value = content.partition(":")
+            properties[name]=value
+        event=None
+        uid=properties.get("UID")
+        if not uid:
+            continue
+        try:
+            sequence=int(properties.get("SEQUENCE", 0))
+        except ValueError:
+            sequence=0
+        events[uid]=( properties.get("X-ROOSTER2ICS-HASH"), sequence, text )
+    return events
+
+def make_unique(entries, log=None):
+    ''' remove duplicate entries, and collaps ones with different groups.
+    Done in a single pass; entries come out in the order they were first
+    seen, with their groups in the order they were first seen. The counts
+    are reported to <log>, if given. '''
+    
+    # entries without their group, each with an ordered set of groups:
+    entryd=OrderedDict()
+    count=0
     for entry in entries:
-        Groep=entry[groupcol]
-        key=list(entry)
-        key[groupcol]=''
-        key=tuple(key)
-        order.append(key)
-        if key in entryd: entryd[key]+=', '+Groep
-        else: entryd[key]=Groep
-            
-    # remove duplicates from order:
-    order = list(set(order))
+        count+=1
+        key=entry._replace(Groep='')
+        try:
+            groups=entryd[key]
+        except KeyError:
+            groups=entryd[key]=OrderedDict()
+        groups[entry.Groep]=None
+    if log:
+        log("Starting with %d entries" % count)
+        log("Now %d unique entries" % 
+            sum(len(groups) for groups in entryd.itervalues()))
+    
     new_entries=[]
-    for key in order:
-        entry=list(key)
-        entry[groupcol]=entryd[key]
-        new_entries.append(tuple(entry))
+    for key, groups in entryd.iteritems():
+        Groep=', '.join(group for group in groups if group)
+        new_entries.append(key._replace(Groep=Groep))
         
-    print "Now", len(new_entries), "entries with groups collapsed"
+    if log: log("Now %d entries with groups collapsed" % len(new_entries))
+    
+    return new_entries
+
+# a weekly series costs about as much calendar text as this many EXDATEs,
+# so compact_entries only splits a series at a longer gap:
+series_exdates=20
+
+def compact_entries(entries, log=None):
+    ''' merges <entries> (as from make_unique) that only differ in their
+    weeks (and so their first date) into as few weekly series as possible:
+    the dates of all of them are taken together, and split into series
+    where a gap of more than series_exdates weeks is cheaper as a new event
+    than as EXDATEs (see render_ical_event), and where a series would run
+    for more than a year. Entries come out in the order
+    they were first seen; one that is not merged comes out as it was.
+    The counts are reported to <log>, if given. '''
+    
+    # entries without their weeks (and weekday, for entries without Dag)
+    # -> date ordinal -> week number:
+    seriesd=OrderedDict()
+    for entry in entries:
+        key=( entry._replace(Begindatum=None, Weken=None),
+              datetime.date(*entry.Begindatum).weekday() )
+        try:
+            weeks=seriesd[key]
+        except KeyError:
+            weeks=seriesd[key]={}
+        dates = academic_calendar.occurrences(entry.Begindatum, entry.Weken)
+        for date, week in zip(dates, entry.Weken):
+            weeks.setdefault(date, week)
+    
+    new_entries=[]
+    for ( key, weekday ), weeks in seriesd.iteritems():
+        dates = sorted(weeks)
+        start = 0
+        first = datetime.date.fromordinal(dates[0])
+        for i in range(1, len(dates)+1):
+            # week numbers only tell the weeks of one year apart (see
+            # AcademicCalendar.occurrences), so a series also ends before
+            # it would run for a year:
+            if i < len(dates) and \
+               ( dates[i]-dates[i-1] )/7-1 <= series_exdates and \
+               ( dates[i]-dates[start] )/7 < weeks_in_year(first.year):
+                continue
+            new_entries.append(key._replace(
+                Begindatum=( first.year, first.month, first.day ),
+                Weken=tuple( weeks[date] for date in dates[start:i] )))
+            if i < len(dates):
+                start = i
+                first = datetime.date.fromordinal(dates[start])
+    
+    if log: log("Now %d entries with recurrences merged" % len(new_entries))
     
     return new_entries
 
 
-def write_ics_entries(outfile, entries):
-    ''' write out calendar <entries> as ICS events to <outfile> '''
+class EntryStore(object):
+    ''' make_unique for more entries than fit in memory: entries added are
+    kept in an sqlite database in <tmpdir> (default the system's temporary
+    directory), which removes duplicates and collects the groups of
+    entries that differ only in group as they come in. Iterating gives
+    the unique entries, with groups collapsed, in the same order as
+    make_unique would; they are read from disk as they are needed, so this
+    can be done more than once. After compact, the entries are merged into
+    recurring events as well. Call close to remove the database. '''
+    
+    def __init__(self, tmpdir=None, batchsize=10000):
+        fd, self.path = tempfile.mkstemp(dir=tmpdir, prefix="rooster2ics",
+                                         suffix=".sqlite")
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        # a scratch database, that need not survive a crash:
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        # entries without their group, numbered in the order first seen:
+        self.db.execute("CREATE TABLE entries "
+                        "( id INTEGER PRIMARY KEY, entry BLOB UNIQUE )")
+        # their groups, numbered in the order first seen:
+        self.db.execute("CREATE TABLE groups "
+                        "( id INTEGER, seen INTEGER, groep TEXT, "
+                        "PRIMARY KEY ( id, groep ) )")
+        self.batchsize = batchsize
+        self.count = 0
+        self.compacted = False
+    
+    def add(self, entries):
+        ''' adds <entries> (any iterable) '''
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= self.batchsize:
+                self.add_batch(batch)
+                batch = []
+        if batch:
+            self.add_batch(batch)
+    
+    def add_batch(self, batch):
+        # marshal version 0 writes equal strings the same way, interned
+        # or not, so equal entries get equal keys:
+        keys = [ sqlite3.Binary(marshal.dumps(tuple(entry._replace(Groep='')),
+                                              0))
+                 for entry in batch ]
+        self.db.executemany("INSERT OR IGNORE INTO entries ( entry ) "
+                            "VALUES ( ? )", ( ( key, ) for key in keys ))
+        self.db.executemany("INSERT OR IGNORE INTO groups ( id, seen, groep ) "
+                            "SELECT id, ?, ? FROM entries WHERE entry = ?",
+                            ( ( self.count+n, entry.Groep, key )
+                              for n, ( entry, key ) in
+                              enumerate(itertools.izip(batch, keys)) ))
+        self.count += len(batch)
+        self.db.commit()
+    
+    def report(self, log):
+        ''' reports the counts to <log>, like make_unique does '''
+        log("Starting with %d entries" % self.count)
+        log("Now %d unique entries" % \
+            self.db.execute("SELECT COUNT(*) FROM groups").fetchone()[0])
+        log("Now %d entries with groups collapsed" % len(self))
+    
+    def compact(self, log=None):
+        ''' compact_entries for the entries in the store: the unique
+        entries are numbered by what they have in common apart from their
+        weeks (in the order first seen), and each such series is read back
+        and merged by itself, so only one series is in memory at a time.
+        Entries come out in the same order as from compact_entries. '''
+        # ( can't commit while reading, as that would reset the reading )
+        self.db.execute("CREATE TABLE series "
+                        "( id INTEGER PRIMARY KEY, key BLOB UNIQUE )")
+        self.db.execute("CREATE TABLE members "
+                        "( id INTEGER PRIMARY KEY, series INTEGER, "
+                        "entry BLOB )")
+        for entry in self:
+            key = sqlite3.Binary(marshal.dumps(
+                ( tuple(entry._replace(Begindatum=None, Weken=None)),
+                  datetime.date(*entry.Begindatum).weekday() ), 0))
+            self.db.execute("INSERT OR IGNORE INTO series ( key ) "
+                            "VALUES ( ? )", ( key, ))
+            self.db.execute("INSERT INTO members ( series, entry ) "
+                            "SELECT id, ? FROM series WHERE key = ?",
+                            ( sqlite3.Binary(marshal.dumps(tuple(entry), 0)),
+                              key ))
+        self.db.execute("CREATE TABLE compacted "
+                        "( id INTEGER PRIMARY KEY, entry BLOB )")
+        rows = self.db.execute("SELECT series, entry FROM members "
+                               "ORDER BY series, id")
+        for series, rows in itertools.groupby(rows, lambda row: row[0]):
+            entries = [ Entry._make(marshal.loads(str(entry)))
+                        for series, entry in rows ]
+            self.db.executemany("INSERT INTO compacted ( entry ) "
+                                "VALUES ( ? )",
+                                ( ( sqlite3.Binary(marshal.dumps(
+                                    tuple(entry), 0)), )
+                                  for entry in compact_entries(entries) ))
+        self.db.execute("DROP TABLE members")
+        self.db.commit()
+        self.compacted = True
+        if log: log("Now %d entries with recurrences merged" % len(self))
+    
+    def __len__(self):
+        if self.compacted:
+            return self.db.execute("SELECT COUNT(*) FROM compacted"
+                                   ).fetchone()[0]
+        return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    
+    def __iter__(self):
+        if self.compacted:
+            for entry, in self.db.execute("SELECT entry FROM compacted "
+                                          "ORDER BY id"):
+                yield Entry._make(marshal.loads(str(entry)))
+            return
+        rows = self.db.execute("SELECT entries.id, entry, groep "
+                               "FROM entries JOIN groups USING ( id ) "
+                               "ORDER BY entries.id, seen")
+        for id, rows in itertools.groupby(rows, lambda row: row[0]):
+            rows = list(rows)
+            entry = Entry._make(marshal.loads(str(rows[0][1])))
+            Groep = ', '.join(groep for id, key, groep in rows if groep)
+            yield entry._replace(Groep=Groep)
+    
+    def close(self):
+        self.db.close()
+        os.remove(self.path)
+
+def write_ics_entries(outfile, entries, version="rooster2ics", progress=False,
+                      previous=None, stats=None, log=None, verbose=False,
+                      reference=None, emitters=()):
+    ''' write out calendar <entries> (see make_unique) as ICS events to
+    <outfile> (anything with a write method), and return the number of
+    events written. If <previous> holds the events of an earlier run (see
+    read_ics_events), the text of events that did not change is written as
+    it was, and only changed ones are rendered again. The render and write
+    stages are timed in <stats> (a Stats) if given. Each entry is reported
+    to <log> if <progress> is set, and rendering in detail if <verbose> is.
+    <reference> is the date (or datetime) written as DTSTAMP, default now.
     
-    now=time.localtime(); # we get the current time once, to prevent 'shifts'
-    this_year=int(time.strftime("%Y", now)); # current year
-    this_week=int(time.strftime("%W", now)); # current week
+    Each entry is also handed to the <emitters> (see Emitter), in the same
+    pass, to be written out in other ways; with those, <outfile> may be
+    None to write no calendar. Events are only rendered if one of the
+    emitters needs them. '''
     
-    # make unique:
-    entries = make_unique(entries)
-    entries_unique = len(entries)
-    print "Now", entries_unique, "unique entries"
+    if stats:
+        start = time.time()
+        write_before = stats.times['write']
+    # we get the current time once, to prevent 'shifts':
+    if reference is None:
+        reference = datetime.datetime.now()
+    dtstamp = time.strftime("%Y%m%dT%H%M%SZ",
+                            time.gmtime(time.mktime(reference.timetuple())))
+    if not log:
+        progress = verbose = False
+    render_log = verbose and log or None
     
-    print >> outfile, "BEGIN:VCALENDAR"
-    for words in entries:
-        # get fields:
-        #print "PROCESSING", words
-        ( Status, Vakcode, Dag, Begindatum, Weken, Start, Einde, Vaknaam,
-          Beschrijving, Groep, Type, Zalen, Docent, Opmerking ) = words
-        print "PROCESSING", \
-            Vaknaam, Vakcode, Dag, Weken, Beschrijving, Docent.split('\n')[0]
+    if previous is None:
+        previous = {}
+    added = modified = unchanged = 0
+    uids = set()
+    entries_written = 0
+    progress = progress or verbose
+    emitters = list(emitters)
+    if outfile is not None:
+        emitters.insert(0, IcsEmitter(outfile, version, stats))
+    render = False
+    for emitter in emitters:
+        emitter.begin()
+        render = render or emitter.needs_text
+    for entry in entries:
+        entries_written += 1
+        if progress:
+            log("PROCESSING %s %s %s %s %s %s" % \
+                ( entry.Vaknaam, entry.Vakcode, entry.Dag, entry.Weken,
+                  entry.Beschrijving, entry.Docent.split('\n')[0] ))
+        
+        # entries that differ only in e.g. room share their identifying
+        # fields; number them to keep each UID unique:
+        uid = base_uid = event_uid(entry)
+        n = 1
+        while uid in uids:
+            n += 1
+            uid = "%s-%d" % ( base_uid, n )
+        uids.add(uid)
+        fingerprint = event_fingerprint(entry)
         
-        write_ical_event(outfile, this_week, this_year, 
-                         Vakcode, Dag, Begindatum, Weken, 
-                         Start, Einde, Vaknaam, Beschrijving, 
-                         Groep, Type, Zalen, Docent, Opmerking)
-    print >> outfile, "END:VCALENDAR"
-    return entries_unique
+        sequence = 0
+        text = None
+        if uid in previous:
+            old_fingerprint, sequence, text = previous[uid]
+            if old_fingerprint == fingerprint:
+                unchanged += 1
+            else:
+                modified += 1
+                sequence += 1
+                text = None
+        else:
+            added += 1
+        if text is None and render:
+            text = render_ical_event(academic_calendar, entry, uid,
+                                     fingerprint, sequence, dtstamp,
+                                     render_log)
+        for emitter in emitters:
+            emitter.write(entry, uid, text)
+    for emitter in emitters:
+        emitter.end()
+    if previous and log:
+        removed = len(set(previous) - uids)
+        log("Events added: %d removed: %d modified: %d unchanged: %d" % \
+            ( added, removed, modified, unchanged ))
+    if stats:
+        stats.events += entries_written
+        # the time not spent writing is rendering:
+        stats.times['render'] += time.time()-start - \
+            ( stats.times['write']-write_before )
+    return entries_written
 
+def write_ics_file(icsfile, entries, version="rooster2ics", progress=False,
+                   previous=None, stats=None, log=None, verbose=False,
+                   emitters=(), reference=None):
+    ''' like write_ics_entries, but writes to the file named <icsfile> (or
+    to no calendar file, if None), which is replaced in one go once it has
+    been written completely, as are the files of the <emitters> '''
 
-######## MAIN ##########
+    outfile = icsfile and AtomicFile(icsfile)
+    try:
+        entries_written = write_ics_entries(outfile, entries, version,
+                                            progress, previous, stats, log,
+                                            verbose, reference, emitters)
+    except:
+        if outfile: outfile.discard()
+        for emitter in emitters:
+            emitter.discard()
+        raise
+    if stats: start = time.time()
+    if outfile: outfile.close()
+    if stats: stats.times['write'] += time.time()-start
+    return entries_written
 
-if __name__ == "__main__":
-    global debug
+######## EMITTERS ##########
+
+class Emitter(object):
+    ''' receives the entries write_ics_entries writes, one by one, to write
+    them out in its own way. For every entry, write is called with its
+    UID and the text of its event (None if no emitter needs_text); begin
+    and end are called before the first and after the last. If something
+    goes wrong on the way, discard is called instead of end. An emitter
+    can be used for more than one run. '''
     
-    # get commandline options and file(s)
-    (options, args, version) = parse_commandline()
+    # whether write needs the rendered event:
+    needs_text = False
+    
+    def begin(self):
+        pass
+    
+    def write(self, entry, uid, text):
+        raise NotImplementedError
+    
+    def end(self):
+        pass
+    
+    def discard(self):
+        pass
+
+class IcsEmitter(Emitter):
+    ''' writes the events as an ICS calendar to <outfile>, in large chunks;
+    the time spent writing is added to <stats> (a Stats) if given '''
+    
+    needs_text = True
+    
+    def __init__(self, outfile, version="rooster2ics", stats=None):
+        self.outfile = outfile
+        self.version = version
+        self.stats = stats
+    
+    def begin(self):
+        self.writer = IcsWriter(self.outfile, stats=self.stats)
+        self.writer.begin_calendar(self.version)
+    
+    def write(self, entry, uid, text):
+        self.writer.write(text)
+    
+    def end(self):
+        self.writer.end_calendar()
+
+def entry_record(entry, uid):
+    ''' returns the fields of <entry> as an OrderedDict of plain values
+    (text and numbers), with its <uid> and the dates it occurs on '''
+    
+    record = OrderedDict()
+    record['uid'] = uid
+    for field, value in zip(Entry._fields, entry):
+        if field == 'Dag':
+            value = value or ''
+        elif field == 'Begindatum':
+            value = "%04d-%02d-%02d" % value
+        elif field == 'Weken':
+            value = list(value)
+        elif field in ( 'Start', 'Einde' ):
+            value = minutes2time(value)
+        record[field] = value
+    record['dates'] = [ datetime.date.fromordinal(date).isoformat()
+                        for date in academic_calendar.occurrences(
+                                entry.Begindatum, entry.Weken) ]
+    return record
+
+class FileEmitter(Emitter):
+    ''' an emitter writing to the file named <path>, which is replaced in
+    one go at the end '''
+    
+    def __init__(self, path):
+        self.path = path
+        self.outfile = None
+    
+    def begin(self):
+        self.outfile = AtomicFile(self.path)
+    
+    def end(self):
+        self.outfile.close()
+        self.outfile = None
+    
+    def discard(self):
+        if self.outfile:
+            self.outfile.discard()
+            self.outfile = None
+
+class CsvEmitter(FileEmitter):
+    ''' writes the entries as CSV, with a header line; week numbers and
+    dates are separated by spaces '''
+    
+    def begin(self):
+        FileEmitter.begin(self)
+        self.writer = csv.writer(self.outfile)
+        self.writer.writerow([ 'uid' ]+list(Entry._fields)+[ 'dates' ])
+    
+    def write(self, entry, uid, text):
+        record = entry_record(entry, uid)
+        record['Weken'] = " ".join(str(week) for week in record['Weken'])
+        record['dates'] = " ".join(record['dates'])
+        self.writer.writerow(record.values())
+
+class JsonLinesEmitter(FileEmitter):
+    ''' writes the entries as JSON Lines: one JSON object per line '''
+    
+    def write(self, entry, uid, text):
+        record = entry_record(entry, uid)
+        self.outfile.write(json.dumps(record)+"\n")
+
+# output formats besides ics, with their emitter (taking the file name):
+emitter_formats = OrderedDict([ ( 'csv', CsvEmitter ),
+                                ( 'jsonl', JsonLinesEmitter ) ])
+
+######## SPLITTING ##########
+
+# fields calendars can be split by, with how to split a field holding more
+# than one value (like the groups make_unique joins):
+shard_fields = OrderedDict([ ( 'Vakcode', None ),
+                             ( 'Groep', re.compile(r'\s*,\s*') ),
+                             ( 'Type', None ),
+                             ( 'Docent', re.compile(r'\s*[\n;]\s*') ),
+                             ( 'Zalen', re.compile(r'\s*,\s*') ) ])
+
+def field_values(entry, field):
+    ''' returns the values of <field> (one of shard_fields) of <entry>, as
+    a list: one value, more for a field holding several, or none '''
+    
+    value = getattr(entry, field)
+    separator = shard_fields[field]
+    if separator:
+        return [ v for v in separator.split(value) if v ]
+    return value and [ value ] or []
+
+def parse_shard_key(text):
+    ''' returns the fields of a split key like 'Vakcode' or 'Vakcode+Type'
+    as a tuple; raises ValueError for an unknown field '''
+    
+    fields = tuple(field.strip() for field in text.split('+'))
+    for field in fields:
+        if field not in shard_fields:
+            raise ValueError(field)
+    return fields
+
+class ShardWriter(Emitter):
+    ''' writes events, as they are rendered, into one calendar per value of
+    each of the split <keys> (tuples of fields, see parse_shard_key): for
+    key ( 'Vakcode', ) one calendar per course, in
+    <directory>/Vakcode/<course>.ics. An entry goes into every calendar
+    of the values it has, so an event for two groups is in both group
+    calendars, and entries without a value for a key in none of them.
+    
+    Events are buffered per calendar, and at most <maxopen> files are
+    open at a time (the least recently used is closed first). Calendars
+    are written under a temporary name, and put in place at the end. '''
+    
+    needs_text = True
+    
+    def __init__(self, directory, keys, version="rooster2ics", maxopen=64,
+                 bufsize=1<<14):
+        self.directory = directory
+        self.keys = keys
+        self.maxopen = maxopen
+        self.bufsize = bufsize
+        # every calendar starts and ends the same way:
+        header = StringIO()
+        writer = IcsWriter(header)
+        writer.begin_calendar(version)
+        writer.flush()
+        self.header = header.getvalue()
+        self.footer = ics_fold("END:VCALENDAR")+"\r\n"
+        # calendars written by the last close:
+        self.written = 0
+        self.reset()
+    
+    def reset(self):
+        # ( key, values ) -> path:
+        self.paths = {}
+        self.names = set()
+        # path -> buffered text and its size:
+        self.buffers = OrderedDict()
+        self.buffered = {}
+        # open files, least recently used first:
+        self.files = OrderedDict()
+        # calendars with a (temporary) file:
+        self.started = set()
+    
+    def path(self, key, values):
+        ''' returns the calendar file for <values> of <key> '''
+        try:
+            return self.paths[key, values]
+        except KeyError:
+            pass
+        keydir = os.path.join(self.directory, "+".join(key))
+        name = "+".join(re.sub(r'[^A-Za-z0-9._-]+', '_', value).strip('_')
+                        or '_' for value in values)
+        path = os.path.join(keydir, name+".ics")
+        # values that only differ in e.g. spaces and slashes need their
+        # own file:
+        if path in self.names:
+            path = os.path.join(keydir, "%s-%s.ics" % \
+                ( name, hashlib.sha1("+".join(values)).hexdigest()[:8] ))
+        self.names.add(path)
+        self.paths[key, values] = path
+        return path
+    
+    def values(self, entry, key):
+        ''' returns the value combinations <entry> has for <key> '''
+        combinations = [ () ]
+        for field in key:
+            combinations = [ combination+( value, )
+                             for combination in combinations
+                             for value in field_values(entry, field) ]
+        return combinations
+    
+    def write(self, entry, uid, text):
+        ''' adds the rendered event <text> of <entry> to its calendars '''
+        for key in self.keys:
+            for values in self.values(entry, key):
+                path = self.path(key, values)
+                buffer = self.buffers.get(path)
+                if buffer is None:
+                    buffer = self.buffers[path] = []
+                    self.buffered[path] = 0
+                buffer.append(text)
+                self.buffered[path] += len(text)
+                if self.buffered[path] >= self.bufsize:
+                    self.flush(path)
+    
+    def open(self, path):
+        ''' returns the open temporary file for calendar <path> '''
+        outfile = self.files.pop(path, None)
+        if outfile is None:
+            if len(self.files) >= self.maxopen:
+                oldpath, oldfile = self.files.popitem(last=False)
+                oldfile.close()
+            if path in self.started:
+                outfile = open(path+".tmp", 'ab')
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                outfile = open(path+".tmp", 'wb')
+                outfile.write(self.header)
+                self.started.add(path)
+        self.files[path] = outfile
+        return outfile
+    
+    def flush(self, path):
+        buffer = self.buffers[path]
+        if buffer:
+            self.open(path).write("".join(buffer))
+            self.buffers[path] = []
+            self.buffered[path] = 0
+    
+    def end(self):
+        ''' finishes all calendars and puts them in place, and removes
+        the calendars of values no longer seen; returns the number of
+        calendars written '''
+        for path in self.buffers:
+            self.flush(path)
+            self.open(path).write(self.footer)
+        for outfile in self.files.itervalues():
+            outfile.close()
+        for path in self.buffers:
+            os.rename(path+".tmp", path)
+        # calendars of values that are gone (since an earlier pass):
+        for key in self.keys:
+            keydir = os.path.join(self.directory, "+".join(key))
+            if not os.path.isdir(keydir):
+                continue
+            for filename in os.listdir(keydir):
+                path = os.path.join(keydir, filename)
+                if filename.endswith(".ics") and path not in self.buffers:
+                    os.remove(path)
+        self.written = len(self.buffers)
+        self.reset()
+        return self.written
+    
+    def discard(self):
+        ''' drops all calendars written so far '''
+        for outfile in self.files.itervalues():
+            outfile.close()
+        for path in self.started:
+            if os.path.isfile(path+".tmp"):
+                os.remove(path+".tmp")
+        self.reset()
+
+######## FILTERING ##########
+
+class EntryIndex(object):
+    ''' inverted indexes over <entries> (as from make_unique), to select
+    entries by course, group, lecturer, room, type and dates without going
+    through all of them for every selection. '''
+    
+    def __init__(self, entries):
+        self.entries = list(entries)
+        # field -> value -> positions of the entries that have it:
+        self.index = dict( ( field, {} ) for field in shard_fields )
+        for position, entry in enumerate(self.entries):
+            for field, values in self.index.iteritems():
+                for value in field_values(entry, field):
+                    values.setdefault(value, []).append(position)
+        # course codes in order, to find those with a prefix:
+        self.courses = sorted(self.index['Vakcode'])
+        # first and last dates (as ordinals), with the entries sorted by
+        # first date:
+        self.spans = []
+        for position, entry in enumerate(self.entries):
+            dates = academic_calendar.occurrences(entry.Begindatum,
+                                                  entry.Weken)
+            self.spans.append( ( dates[0], dates[-1] ) )
+        self.by_first = sorted( ( first, position ) for position, ( first, last )
+                                in enumerate(self.spans) )
+        self.firsts = [ first for first, position in self.by_first ]
+    
+    def lookup(self, field, values):
+        ''' returns the positions of the entries with any of <values> for
+        <field>, as a set '''
+        positions = set()
+        index = self.index[field]
+        for value in values:
+            positions.update(index.get(value, ()))
+        return positions
+    
+    def courses_with_prefix(self, prefixes):
+        ''' returns the positions of the entries with a course code
+        starting with any of <prefixes>, as a set '''
+        positions = set()
+        index = self.index['Vakcode']
+        for prefix in prefixes:
+            n = bisect.bisect_left(self.courses, prefix)
+            while n < len(self.courses) and \
+                    self.courses[n].startswith(prefix):
+                positions.update(index[self.courses[n]])
+                n += 1
+        return positions
+    
+    def between(self, start=None, end=None):
+        ''' returns the positions of the entries with occurrences from date
+        <start> up to and including date <end> (either may be None), as a
+        set. Entries are selected whole: a series starting before <start>
+        is kept with all its occurrences. '''
+        if end is None:
+            candidates = self.by_first
+        else:
+            candidates = self.by_first[:bisect.bisect_right(self.firsts,
+                                                            end.toordinal())]
+        if start is None:
+            return set( position for first, position in candidates )
+        start = start.toordinal()
+        return set( position for first, position in candidates
+                    if self.spans[position][1] >= start )
+    
+    def select(self, course=(), group=(), docent=(), room=(), type=(),
+               start=None, end=None):
+        ''' returns the entries matching all of the given criteria, in
+        their original order. <course> is a list of course code prefixes;
+        <group>, <docent>, <room> and <type> are lists of values, of which
+        an entry needs to have one; <start> and <end> are dates, see
+        between. '''
+        selections = []
+        if course:
+            selections.append(self.courses_with_prefix(course))
+        for field, values in ( ( 'Groep', group ), ( 'Docent', docent ),
+                               ( 'Zalen', room ), ( 'Type', type ) ):
+            if values:
+                selections.append(self.lookup(field, values))
+        if start or end:
+            selections.append(self.between(start, end))
+        if not selections:
+            return list(self.entries)
+        # intersect the smallest sets first:
+        selections.sort(key=len)
+        positions = selections[0]
+        for selection in selections[1:]:
+            if not positions:
+                break
+            positions = positions & selection
+        return [ self.entries[position] for position in sorted(positions) ]
+
+######## CONFLICTS ##########
+
+# one double booking: two entries using the same room (or lecturer) at the
+# same time; date is a datetime.date, start and end the minutes of the
+# overlap:
+Conflict = namedtuple('Conflict', [ 'kind', 'resource', 'date', 'start',
+                                    'end', 'first', 'second' ])
+
+# resources that can't be in two places at once:
+conflict_kinds = [ ( 'room', 'Zalen' ), ( 'docent', 'Docent' ) ]
+
+def find_conflicts(entries):
+    ''' yields a Conflict for each pair of <entries> (as from make_unique)
+    that use the same room or lecturer at the same time, on each date they
+    overlap. Each entry is expanded into its occurrences (see
+    AcademicCalendar), and the occurrences of each room and lecturer are
+    swept in order of start time, keeping the ones still going in a heap;
+    this takes O(n log n) for n occurrences, plus the conflicts found. '''
+    
+    # ( kind, resource ) -> [ ( start, end, entry ) ], with start and end
+    # in minutes from the start of the calendar:
+    occupied = {}
+    for entry in entries:
+        if entry.Einde <= entry.Start:
+            continue
+        dates = academic_calendar.occurrences(entry.Begindatum, entry.Weken)
+        for kind, field in conflict_kinds:
+            for resource in field_values(entry, field):
+                intervals = occupied.setdefault(( kind, resource ), [])
+                for date in dates:
+                    intervals.append( ( date*1440+entry.Start,
+                                        date*1440+entry.Einde, entry ) )
+    
+    for ( kind, resource ) in sorted(occupied):
+        intervals = occupied[kind, resource]
+        intervals.sort(key=lambda interval: interval[:2])
+        # ( end, n, entry ) of the occurrences still going:
+        active = []
+        for n, ( start, end, entry ) in enumerate(intervals):
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+            for other_end, other_n, other in active:
+                # (a week listed twice is no double booking)
+                if other is entry:
+                    continue
+                date, minutes = divmod(start, 1440)
+                yield Conflict(kind, resource,
+                               datetime.date.fromordinal(date), minutes,
+                               min(end, other_end)-date*1440, other, entry)
+            heapq.heappush(active, ( end, n, entry ))
+
+def write_conflicts(outfile, conflicts, format='csv'):
+    ''' writes <conflicts> (see find_conflicts) to <outfile> as CSV (with a
+    header line) or as JSON, and returns how many were written '''
+    
+    def describe(entry):
+        return OrderedDict([ ( 'Vakcode', entry.Vakcode ),
+                             ( 'Vaknaam', entry.Vaknaam ),
+                             ( 'Type', entry.Type ),
+                             ( 'Groep', entry.Groep ),
+                             ( 'Start', minutes2time(entry.Start) ),
+                             ( 'Einde', minutes2time(entry.Einde) ),
+                             ( 'uid', event_uid(entry) ) ])
+    
+    count = 0
+    if format == 'json':
+        records = []
+        for conflict in conflicts:
+            records.append(OrderedDict([
+                ( 'kind', conflict.kind ),
+                ( 'resource', conflict.resource ),
+                ( 'date', conflict.date.isoformat() ),
+                ( 'start', minutes2time(conflict.start) ),
+                ( 'end', minutes2time(conflict.end) ),
+                ( 'first', describe(conflict.first) ),
+                ( 'second', describe(conflict.second) ) ]))
+        json.dump(records, outfile, indent=1, separators=( ",", ": " ))
+        outfile.write("\n")
+        return len(records)
+    
+    writer = csv.writer(outfile)
+    fields = [ 'Vakcode', 'Vaknaam', 'Type', 'Groep', 'Start', 'Einde', 'uid' ]
+    writer.writerow([ 'kind', 'resource', 'date', 'start', 'end' ] +
+                    [ 'first '+field for field in fields ] +
+                    [ 'second '+field for field in fields ])
+    for conflict in conflicts:
+        writer.writerow([ conflict.kind, conflict.resource,
+                          conflict.date.isoformat(),
+                          minutes2time(conflict.start),
+                          minutes2time(conflict.end) ] +
+                        describe(conflict.first).values() +
+                        describe(conflict.second).values())
+        count += 1
+    return count
+
+######## WATCHING ##########
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class Watcher(object):
+    ''' watches rooster files (and directories of rooster files, as for
+    expand_roosterfiles) given by <names>, and tells which changed; the
+    files in <exclude> (our outputs) are left out. Uses inotify if
+    pyinotify is installed, and otherwise looks every <interval> seconds. '''
+
+    def __init__(self, names, interval=1., log=None, exclude=()):
+        self.names = names
+        self.exclude = exclude
+        self.interval = interval
+        self.signatures = self.scan()
+        self.notifier = None
+        if pyinotify:
+            class Wakeup(pyinotify.ProcessEvent):
+                def process_default(self, event):
+                    pass
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.Notifier(manager, Wakeup())
+            # watch the directories, to also see files being replaced:
+            directories = set()
+            for name in names:
+                if os.path.isdir(name):
+                    directories.add(name)
+                else:
+                    directories.add(os.path.dirname(name) or '.')
+            manager.add_watch(sorted(directories),
+                              pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY |
+                              pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                              pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM)
+            if log: log("Watching with inotify")
+        elif log:
+            log("Watching by looking every %g seconds" % interval)
+
+    def roosterfiles(self):
+        ''' returns the rooster files as they are now '''
+        return [ roosterfile for roosterfile in
+                 expand_roosterfiles(self.names, self.exclude)
+                 if roosterfile in self.signatures ]
+
+    def scan(self):
+        ''' returns a dict of rooster file -> ( mtime, size, inode ), of the
+        rooster files that exist now '''
+        signatures = {}
+        for roosterfile in expand_roosterfiles(self.names, self.exclude):
+            try:
+                st = os.stat(roosterfile)
+            except OSError:
+                continue
+            signatures[roosterfile] = ( st.st_mtime, st.st_size, st.st_ino )
+        return signatures
+
+    def sleep(self, seconds):
+        ''' waits <seconds>, or less if inotify sees something happen '''
+        if self.notifier:
+            if self.notifier.check_events(int(seconds*1000)):
+                self.notifier.read_events()
+                self.notifier.process_events()
+        else:
+            time.sleep(seconds)
+
+    def wait(self, debounce=1.):
+        ''' waits until rooster files change, are added or are removed, and
+        then until they stay unchanged for <debounce> seconds (so a burst
+        of changes, like saving several files, is taken in one go).
+        Returns the set of rooster files that changed or were added, and
+        the set of those removed. '''
+        while True:
+            self.sleep(self.interval)
+            signatures = self.scan()
+            if signatures != self.signatures:
+                break
+        while True:
+            time.sleep(debounce)
+            later = self.scan()
+            if later == signatures:
+                break
+            signatures = later
+        changed = set( roosterfile for roosterfile in signatures
+                       if signatures[roosterfile] !=
+                       self.signatures.get(roosterfile) )
+        removed = set(self.signatures)-set(signatures)
+        self.signatures = signatures
+        return changed, removed
+
+def watch_rooster_files(watcher, per_file, icsfile, version="rooster2ics",
+                        cache=None, debounce=1., log=None,
+                        verbose=False, emitters=(), filters=None,
+                        compact=True, conflicts=None, conflictsfile=None):
+    ''' writes <icsfile> again whenever <watcher> (a Watcher) sees rooster
+    files change, until interrupted. <per_file> holds the entries read
+    from each rooster file so far; only the rooster files that changed are
+    read again; one that can not be read is tried again in the next round,
+    and errors in a round are reported to <log> without ending the watch.
+    Events that did not change keep their text and SEQUENCE. <cache> is
+    as for read_rooster_file, <emitters> as for
+    write_ics_file; only the entries selected by <filters> (arguments for
+    EntryIndex.select) are written, if given, merged into recurring events
+    by compact_entries if <compact> is set. If <conflicts> is a format
+    (see write_conflicts), the conflicts are reported in <conflictsfile>
+    again as well. '''
+
+    while True:
+        changed, removed = watcher.wait(debounce)
+        try:
+            write_watched_files(watcher, per_file, changed, removed, icsfile,
+                                version, cache, log, verbose, emitters,
+                                filters, compact, conflicts, conflictsfile)
+        except Exception, e:
+            if log: log("ERROR: could not convert rooster files: %s: %s" %
+                        ( e.__class__.__name__, e ))
+
+def write_watched_files(watcher, per_file, changed, removed, icsfile,
+                        version="rooster2ics", cache=None, log=None,
+                        verbose=False, emitters=(), filters=None,
+                        compact=True, conflicts=None, conflictsfile=None):
+    ''' one round of watch_rooster_files, for the rooster files <changed>
+    and <removed> as told by <watcher> '''
+
+    verbose_log = verbose and log or None
+    roosterfiles = watcher.roosterfiles()
+    changed = [ f for f in roosterfiles if f in changed ]
+    for roosterfile in removed:
+        if log: log("Removed: "+roosterfile)
+        per_file.pop(roosterfile, None)
+    for roosterfile in changed:
+        try:
+            entries = read_rooster_file(roosterfile, cache, None, verbose_log)
+        except Exception, e:
+            # most likely removed or half written while we read it; forget
+            # we saw it, so the next round reads it again (or tells it is
+            # gone):
+            if log: log("WARNING: could not read rooster file %s: %s" %
+                        ( roosterfile, e ))
+            watcher.signatures.pop(roosterfile, None)
+            continue
+        if log: log("Changed: %s (%d entries)" % ( roosterfile,
+                                                    len(entries) ))
+        per_file[roosterfile] = entries
+    entries = []
+    for roosterfile in roosterfiles:
+        entries.extend(per_file.get(roosterfile, []))
+    entries = make_unique(entries, verbose_log)
+    if filters:
+        entries = EntryIndex(entries).select(**filters)
+    if compact:
+        entries = compact_entries(entries, log=verbose_log)
+    previous = None
+    if icsfile and os.path.isfile(icsfile):
+        infile = open(icsfile, 'rb')
+        previous = read_ics_events(infile)
+        infile.close()
+    entries_written = write_ics_file(icsfile, entries, version,
+                                     previous=previous, log=log,
+                                     verbose=verbose, emitters=emitters,
+                                     reference=last_modified(roosterfiles))
+    if log: log("Wrote %d unique entries" % entries_written)
+    if conflicts:
+        outfile = AtomicFile(conflictsfile)
+        found = write_conflicts(outfile, find_conflicts(entries), conflicts)
+        outfile.close()
+        if log: log("Found %d conflicts" % found)
 
-    # set debug flag
-    debug = options.debug
+######## LIBRARY INTERFACE ##########
+
+def print_log(message):
+    ''' <log> function that prints messages on stdout '''
+    print message
+
+def convert(source, sink, reference=None, version="rooster2ics",
+            previous=None, stats=None, log=None, verbose=False, compact=True):
+    ''' converts a rooster into an ICS calendar, for use from other code.
+    <source> is the rooster as text, or any iterable of its lines (like an
+    open file); the calendar is written to <sink> (anything with a write
+    method) in large chunks. Returns the number of events written.
+    
+    Nothing is printed and no global state is used, so conversions can
+    run in parallel threads. Messages go to <log> (a function taking one
+    string), in detail if <verbose> is set; <reference> is the date (or
+    datetime) written as DTSTAMP, default now; <previous> and <stats> are as
+    for write_ics_entries. Rows that only differ in their weeks are merged
+    into recurring events (see compact_entries), unless <compact> is off. '''
+    
+    entries = read_rooster(source, stats, verbose and log or None)
+    if stats:
+        # parse everything first, to time parsing and dedup apart:
+        start = time.time()
+        entries = list(entries)
+        stats.times['parse'] += time.time()-start
+        start = time.time()
+    entries = make_unique(entries, log)
+    if compact:
+        entries = compact_entries(entries, log)
+    if stats: stats.times['dedup'] += time.time()-start
+    return write_ics_entries(sink, entries, version, False, previous, stats,
+                             log, verbose, reference)
+
+def convert_text(source, reference=None, version="rooster2ics", **options):
+    ''' like convert, but returns the calendar as a string '''
+    
+    sink = StringIO()
+    convert(source, sink, reference, version, **options)
+    return sink.getvalue()
+
+
+######## BATCH ##########
+
+def convert_files(options, version, cache=None, log=print_log):
+    ''' reads the rooster files and writes the outputs for one command line
+    (see parse_commandline) with its <options>, using <cache> (an
+    EntryCache) if given, and reports to <log> as it goes. Returns
+    ( entries_unique, per_file, icsfile, emitters ): the number of entries
+    written, the entries of each file (None with --external), and the ics
+    file and emitters written to, for watch_rooster_files to keep using. '''
+    
+    verbose_log = options.debug and log or None
+    stats = options.stats and Stats() or None
+    store = None
+    per_file = None
+    if options.external:
+        # pass the entries on to disk file by file, and make them unique
+        # there (so the dedup time is counted as reading and parsing):
+        store = EntryStore(options.tmpdir)
+        for file_entries in iter_rooster_files(options.roosterfiles,
+                                               options.jobs, cache, stats,
+                                               verbose_log):
+            store.add(file_entries)
+        entries_input = store.count
+        print "Read", entries_input, "entries from input"
+        store.report(log)
+        entries = store
+    else:
+        per_file = read_rooster_files(options.roosterfiles, options.jobs,
+                                      cache, stats, verbose_log,
+                                      separate=True)
+        entries = [ entry for file_entries in per_file
+                    for entry in file_entries ]
+        
+        entries_input = len(entries)
+        print "Read", entries_input, "entries from input"
         
-    # ingest whole input file:
-    lines = open(options.roosterfile).read()
+        # make unique:
+        if stats: start = time.time()
+        entries = make_unique(entries, log)
+        if stats: stats.times['dedup'] += time.time()-start
     
-    # create list to story rooster entries from roosterfile:
-    entries = read_vu_rooster(lines)
+    # only keep the events asked for:
+    if options.filters:
+        entries = EntryIndex(entries).select(**options.filters)
+        print "Selected", len(entries), "entries"
     
-    entries_input = len(entries)
-    print "Read", entries_input, "entries from input"
+    # merge rows into recurring events (on disk, for --external):
+    if options.compact:
+        if stats: start = time.time()
+        if entries is store:
+            store.compact(log=log)
+        else:
+            entries = compact_entries(entries, log=log)
+        if stats: stats.times['dedup'] += time.time()-start
+    
+    # read events from the previous run, to only render changed ones:
+    previous = None
+    icsfile = 'ics' in options.formats and options.icsfile or None
+    if options.update and icsfile and os.path.isfile(icsfile):
+        infile = open(options.icsfile, 'rb')
+        previous = read_ics_events(infile)
+        infile.close()
+        print "Read", len(previous), "events from", options.icsfile
+    
+    # other formats, and calendars to split the events into, are all
+    # written while going through the entries once:
+    emitters = [ emitter_formats[format](outfile)
+                 for format, outfile in options.outfiles.iteritems() ]
+    shards = None
+    if options.split:
+        shards = ShardWriter(options.splitdir, options.split, version,
+                             options.maxopen)
+        emitters.append(shards)
     
     # now go through records and write out:
-    print "Writing to", options.icsfile
-    outfile = open(options.icsfile, 'w')
-    entries_unique = write_ics_entries(outfile, entries)
+    outputs = ( icsfile and [ icsfile ] or [] )+options.outfiles.values()
+    print "Writing to", ", ".join(outputs)
+    entries_unique = write_ics_file(icsfile, entries, version,
+                                    options.progress, previous, stats,
+                                    log, options.debug, emitters,
+                                    last_modified(options.roosterfiles))
 
     print ""
     print "Summary:"
-    print "Read", entries_input, "entries from", options.roosterfile
-    print "Wrote", entries_unique, "unique entries to", options.icsfile
+    if len(options.roosterfiles)==1:
+        print "Read", entries_input, "entries from", options.roosterfiles[0]
+    else:
+        print "Read", entries_input, "entries from", \
+            len(options.roosterfiles), "files"
+    for output in outputs:
+        print "Wrote", entries_unique, "unique entries to", output
+    if shards:
+        print "Wrote", shards.written, "split calendars to", options.splitdir
+    if options.conflicts:
+        outfile = AtomicFile(options.conflictsfile)
+        conflicts = write_conflicts(outfile, find_conflicts(entries),
+                                    options.conflicts)
+        outfile.close()
+        print "Found", conflicts, "conflicts, reported in", \
+            options.conflictsfile
+    if store: store.close()
+    if stats:
+        print ""
+        stats.report()
+    return entries_unique, per_file, icsfile, emitters
+
+def read_manifest(manifestfile):
+    ''' reads the jobs listed in <manifestfile>, and returns them as a list
+    of ( output, arguments ), with the command line arguments of each job
+    (as for parse_commandline). A JSON manifest holds a list of jobs like
+    
+      { "input": "a.txt", "output": "a.ics", "options": [ "-f", "csv" ] }
+    
+    where input may also be a list of rooster files and directories, and
+    options one string. A TSV manifest has a line per job, with the input,
+    the output and the options separated by tabs; empty lines and lines
+    starting with # are skipped. Without an output, a job of one input
+    writes next to it, like the command line does, but then overwrites an
+    existing ics file as well. Raises ValueError for a job that can not
+    be made sense of. '''
+    
+    text = open(manifestfile).read()
+    jobs = []
+    if manifestfile.endswith(".json") or text.lstrip()[:1] in ( '[', '{' ):
+        for job in json.loads(text):
+            if not isinstance(job, dict) or not job.get("input"):
+                raise ValueError("job without input: %r" % ( job, ))
+            inputs = job["input"]
+            if isinstance(inputs, basestring):
+                inputs = [ inputs ]
+            arguments = job.get("options") or []
+            if isinstance(arguments, basestring):
+                arguments = shlex.split(arguments)
+            jobs.append(( job.get("output"), [ str(argument) for argument in
+                                               arguments ], inputs ))
+    else:
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            columns = line.split('\t')
+            if not columns[0].strip():
+                raise ValueError("job without input on line %d" % number)
+            output = len(columns)>1 and columns[1].strip() or None
+            arguments = []
+            for column in columns[2:]:
+                arguments += shlex.split(column)
+            jobs.append(( output, arguments, [ columns[0].strip() ] ))
+    manifest = []
+    for output, arguments, inputs in jobs:
+        if not output:
+            if len(inputs)>1:
+                raise ValueError("no output given for multiple inputs: %s" %
+                                 " ".join(inputs))
+            output = os.path.splitext(inputs[0].rstrip(os.sep))[0]+".ics"
+        manifest.append(( output, arguments+inputs+[ "-o", output ] ))
+    return manifest
+
+def run_manifest(options, log=print_log):
+    ''' runs all jobs in the manifest of <options> (see read_manifest) one
+    after the other, sharing the parser and caches (so week and date
+    tables, compiled row checks and cached entries are only made once),
+    and prints the exit status of each job at the end. The other options
+    given with the manifest (like -v, -s, -j or --cache-dir) are the
+    defaults for every job. Jobs that fail do not stop the batch. Returns
+    the number of failed jobs. '''
+    
+    try:
+        manifest = read_manifest(options.manifest)
+    except (IOError, ValueError), e:
+        print "ERROR: can not read manifest %s: %s" % ( options.manifest, e )
+        sys.exit(-1)
+    parser = make_parser()
+    defaults = dict(vars(options))
+    for name in [ 'manifest', 'roosterfiles', 'icsfile' ]:
+        del defaults[name]
+    parser.set_defaults(**defaults)
+    # ( cache directory, size ) -> EntryCache, shared by the jobs using it:
+    caches = {}
+    
+    start = time.time()
+    results = []
+    for number, ( output, arguments ) in enumerate(manifest, 1):
+        print ""
+        print "Job %d of %d: %s" % ( number, len(manifest),
+                                     " ".join(arguments) )
+        sys.stdout.flush()
+        job_start = time.time()
+        status = 0
+        entries_unique = None
+        try:
+            job, args, version = parse_commandline(arguments, parser)
+            if job.manifest or job.watch:
+                print "ERROR: a job can not use --manifest or --watch"
+                sys.exit(-1)
+            cache = None
+            if job.cache:
+                cache = caches.get(( job.cachedir, job.cachesize ))
+                if cache is None:
+                    cache = caches[job.cachedir, job.cachesize] = \
+                        EntryCache(job.cachedir, job.cachesize<<20, log,
+                                   job.debug)
+            entries_unique = convert_files(job, version, cache, log)[0]
+        except SystemExit, e:
+            status = e.code
+        except Exception, e:
+            print "ERROR: %s: %s" % ( e.__class__.__name__, e )
+            status = 1
+        results.append(( output, status, entries_unique,
+                         time.time()-job_start ))
+    
+    failed = sum(1 for result in results if result[1])
+    print ""
+    print "Batch summary:"
+    for output, status, entries_unique, seconds in results:
+        print "  %-8s %8s entries %8.3f s  %s" % \
+            ( status and "exit %d" % status or "ok",
+              entries_unique is None and "-" or entries_unique,
+              seconds, output )
+    print "Ran %d jobs in %.3f s, %d failed" % ( len(results),
+                                                  time.time()-start, failed )
+    return failed
+
+######## MAIN ##########
+
+if __name__ == "__main__":
+    
+    # get commandline options and file(s)
+    (options, args, version) = parse_commandline()
+
+    # where to report to:
+    log = print_log
+    
+    # many conversions in one go:
+    if options.manifest:
+        failed = run_manifest(options, log)
+        sys.exit(failed and 1 or 0)
+        
+    # create list to story rooster entries from roosterfile(s):
+    if options.cache:
+        cache = EntryCache(options.cachedir, options.cachesize<<20, log,
+                           options.debug)
+    else:
+        cache = None
+    entries_unique, per_file, icsfile, emitters = \
+        convert_files(options, version, cache, log)
+    
+    # keep the ics file up to date:
+    if options.watch:
+        print ""
+        print "Watching", len(options.roosterfiles), "rooster file(s) " \
+            "for changes, press ctrl-c to stop"
+        watcher = Watcher(options.inputs, options.interval, log,
+                          options.outputs)
+        sys.stdout.flush()
+        try:
+            watch_rooster_files(watcher,
+                                dict(zip(options.roosterfiles, per_file)),
+                                icsfile, version, cache, options.debounce, log, options.debug,
+                                emitters, options.filters, options.compact,
+                                options.conflicts, options.conflictsfile)
+        except KeyboardInterrupt:
+            print ""
     
 # last line
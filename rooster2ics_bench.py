@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# This software is provided as-is, and comes without any warranty whatsoever.
+# If it works for you, great, let me know! If it doesn't work for you, I'd be happy to try
+# and help you fix it. If it destroys your universe, too bad (you may still file a bug report).
+#
+# Benchmarks the stages of rooster2ics (read_rooster, make_unique and
+# write_ics_entries) on synthetic rooster files of several sizes, and keeps
+# the results, so runs can be compared.
+
+import sys
+import os
+import time
+import json
+import socket
+import shutil
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from optparse import OptionParser
+
+import rooster2ics
+import rooster2ics_synth
+
+######## globals #########
+
+# benchmark sizes: ( name, courses, rows )
+sizes = [ ( 'small',    20,   1000 ),
+          ( 'medium',  200,  20000 ),
+          ( 'faculty', 2000, 300000 ) ]
+
+######## COMMAND LINE / INPUT STUFF ##########
+
+def parse_commandline():
+    usage = "%prog [options]"
+    version = "0.1"
+    description = \
+        "%prog times the stages of rooster2ics on synthetic rooster files, "\
+        "and appends the results to a results file."
+    parser = OptionParser(usage=usage, description=description,
+                          version="%prog "+version)
+
+    names = [ size[0] for size in sizes ]
+    parser.add_option("-s", "--size", dest="sizes", action="append",
+                      choices=names, metavar="SIZE",
+                      help="size to run, one of: %s; may be given more "
+                      "than once (default: all)" % ", ".join(names))
+    parser.set_defaults(sizes=[])
+    parser.add_option("-n", "--repeat", dest="repeat", type="int",
+                      help="number of runs per size, the best time of "
+                      "which is kept (%default)")
+    parser.set_defaults(repeat=3)
+    parser.add_option("-l", "--layout", dest="layout",
+                      choices=rooster2ics_synth.layouts,
+                      help="header layout of the rooster files (%default)")
+    parser.set_defaults(layout="status")
+    parser.add_option("-d", "--duplicates", dest="duplicates", type="float",
+                      help="fraction of duplicate rows (%default)")
+    parser.set_defaults(duplicates=0.1)
+    parser.add_option("-r", "--results", dest="resultsfile", metavar="FILE",
+                      help="file to append results to, one JSON record per "
+                      "line (%default)")
+    parser.set_defaults(resultsfile="bench_results.jsonl")
+    parser.add_option("-c", "--compare", dest="compare", action="store_true",
+                      help="only compare the last two runs in the results "
+                      "file (%default)")
+    parser.set_defaults(compare=False)
+
+    # get the options:
+    (options, args) = parser.parse_args()
+
+    if len(args):
+        parser.print_help()
+        print ""
+        print "ERROR: too many argument, or unknown option(s)"
+        print args
+        sys.exit(-1)
+    if options.repeat < 1:
+        print "ERROR: need at least one run per size"
+        sys.exit(-1)
+    if not options.sizes:
+        options.sizes = names
+
+    # clean up (recommended):
+    del(parser)
+    return options, args
+
+######## BENCHMARKING ##########
+
+def peak_memory():
+    ''' returns the peak memory use of this process so far, in MB '''
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, Mac OS X bytes:
+    if sys.platform == 'darwin':
+        return peak/float(1<<20)
+    return peak/1024.
+
+def run_stages(roosterfile, icsfile, queue):
+    ''' times the stages on <roosterfile>, and puts the timings and peak
+    memory after each stage on <queue>. Runs in a fresh process, so the
+    memory (and memoized values) of earlier runs don't count. '''
+
+    # keep the progress output of rooster2ics out of the way:
+    sys.stdout = open(os.devnull, 'w')
+    result = {}
+
+    start = time.time()
+    infile = open(roosterfile)
+    entries = list(rooster2ics.read_rooster(infile))
+    infile.close()
+    result['read'] = time.time()-start
+    result['read_peak_mb'] = peak_memory()
+    result['entries'] = len(entries)
+
+    start = time.time()
+    entries = rooster2ics.make_unique(entries)
+    result['unique'] = time.time()-start
+    result['unique_peak_mb'] = peak_memory()
+    result['unique_entries'] = len(entries)
+
+    start = time.time()
+    outfile = open(icsfile, 'wb')
+    rooster2ics.write_ics_entries(outfile, entries)
+    outfile.close()
+    result['write'] = time.time()-start
+    result['write_peak_mb'] = peak_memory()
+
+    queue.put(result)
+
+def bench_size(name, courses, rows, options, tmpdir):
+    ''' runs the benchmark for one size, returns its result record '''
+
+    roosterfile = os.path.join(tmpdir, name+".txt")
+    icsfile = os.path.join(tmpdir, name+".ics")
+    # generate the same rooster for every run:
+    settings = rooster2ics_synth.Settings(
+        courses=courses, rows=rows, weeks='mixed', groups=4,
+        layout=options.layout, duplicates=options.duplicates, year=2016,
+        seed=1)
+    outfile = open(roosterfile, 'w')
+    rooster2ics_synth.write_rooster(outfile, settings)
+    outfile.close()
+
+    best = None
+    for run in range(options.repeat):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_stages,
+                                          args=(roosterfile, icsfile, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if best is None:
+            best = result
+        else:
+            # keep the best time (and lowest peak) of each stage:
+            for key in result:
+                if key in ( 'read', 'unique', 'write' ) or \
+                   key.endswith('_peak_mb'):
+                    best[key] = min(best[key], result[key])
+
+    best['size'] = name
+    best['rows'] = rows
+    best['courses'] = courses
+    best['input_mb'] = os.path.getsize(roosterfile)/float(1<<20)
+    best['total'] = best['read']+best['unique']+best['write']
+    best['rows_per_s'] = rows/best['total'] if best['total'] else None
+    return best
+
+def git_revision():
+    ''' returns the git revision of rooster2ics, if we can find it '''
+
+    try:
+        here = os.path.dirname(os.path.abspath(rooster2ics.__file__))
+        revision = subprocess.Popen([ "git", "rev-parse", "--short", "HEAD" ],
+                                    cwd=here, stdout=subprocess.PIPE,
+                                    stderr=open(os.devnull, 'w'))
+        return revision.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def print_results(results, previous=None):
+    ''' prints a table of <results>, compared to <previous> if given '''
+
+    print "%-8s %8s %8s %8s %8s %8s %10s %8s" % \
+        ( "size", "rows", "read", "unique", "write", "total", "rows/s",
+          "peak MB" )
+    before = {}
+    if previous:
+        for result in previous['results']:
+            before[result['size']] = result
+    for result in results:
+        print "%-8s %8d %8.3f %8.3f %8.3f %8.3f %10.0f %8.1f" % \
+            ( result['size'], result['rows'], result['read'],
+              result['unique'], result['write'], result['total'],
+              result['rows_per_s'] or 0, result['write_peak_mb'] )
+        old = before.get(result['size'])
+        if old:
+            print "%-8s %8s %+7.0f%% %+7.0f%% %+7.0f%% %+7.0f%% %10s %+7.0f%%" % \
+                ( "", "vs "+(previous.get('revision') or "prev")[:5],
+                  change(old['read'], result['read']),
+                  change(old['unique'], result['unique']),
+                  change(old['write'], result['write']),
+                  change(old['total'], result['total']), "",
+                  change(old['write_peak_mb'], result['write_peak_mb']) )
+
+def change(old, new):
+    ''' returns the change from <old> to <new> in percent '''
+
+    if not old:
+        return 0.
+    return 100.*(new-old)/old
+
+def read_runs(resultsfile):
+    ''' returns the runs recorded in <resultsfile>, oldest first '''
+
+    runs = []
+    if os.path.isfile(resultsfile):
+        for line in open(resultsfile):
+            if line.strip():
+                runs.append(json.loads(line))
+    return runs
+
+######## MAIN ##########
+
+if __name__ == "__main__":
+
+    # get commandline options and file(s)
+    (options, args) = parse_commandline()
+
+    runs = read_runs(options.resultsfile)
+    if options.compare:
+        if not runs:
+            print "ERROR: no runs in", options.resultsfile
+            sys.exit(-1)
+        print_results(runs[-1]['results'], len(runs)>1 and runs[-2] or None)
+        sys.exit(0)
+
+    tmpdir = tempfile.mkdtemp(prefix="rooster2ics_bench")
+    results = []
+    try:
+        for name, courses, rows in sizes:
+            if name not in options.sizes:
+                continue
+            print "Running", name, "(%d rows)" % rows
+            sys.stdout.flush()
+            results.append(bench_size(name, courses, rows, options, tmpdir))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    run = { 'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'revision': git_revision(),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'layout': options.layout,
+            'duplicates': options.duplicates,
+            'repeat': options.repeat,
+            'results': results }
+    outfile = open(options.resultsfile, 'a')
+    print >>outfile, json.dumps(run, sort_keys=True)
+    outfile.close()
+
+    # compare with the last run of the same sizes and settings:
+    previous = None
+    for old in reversed(runs):
+        if old.get('layout') == run['layout'] and \
+           old.get('duplicates') == run['duplicates']:
+            previous = old
+            break
+    print ""
+    print_results(results, previous)
+    print ""
+    print "Results appended to", options.resultsfile
+
+# last line
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+
+# This software is provided as-is, and comes without any warranty whatsoever.
+# If it works for you, great, let me know! If it doesn't work for you, I'd be happy to try
+# and help you fix it. If it destroys your universe, too bad (you may still file a bug report).
+#
+# Downloads the schedule pages of many courses (or groups) at once, instead
+# of opening each in a browser and pasting it into a text file, and converts
+# them into one ICS calendar.
+#
+# Pages are fetched by a fixed number of worker threads over pooled
+# keep-alive connections, with retries and exponential backoff. The URL of
+# each page comes from a template, so this also works against a local
+# stand-in server with recorded pages (as saved with --save), e.g.:
+#
+#   python -m SimpleHTTPServer 8000     (in the directory with the pages)
+#   rooster2ics_fetch.py -u http://localhost:8000/%s.txt -o out.ics X_405052
+
+import sys
+import os
+import time
+import zlib
+import random
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+import Queue
+
+from optparse import OptionParser
+
+import rooster2ics
+
+######## globals #########
+
+# HTTP statuses worth trying again (after a while):
+retry_statuses = set([ 408, 429, 500, 502, 503, 504 ])
+
+######## COMMAND LINE / INPUT STUFF ##########
+
+def parse_commandline():
+    usage = "%prog [options] -u <url template> -o <ics file> [id ...]"
+    version = "0.1"
+    description = \
+        "%prog downloads the schedule pages of the given course or group "\
+        "ids, and writes them as one ICS calendar file. The URL of each "\
+        "page is the template with %s replaced by the id."
+    parser = OptionParser(usage=usage, description=description,
+                          version="%prog "+version)
+
+    parser.add_option("-u", "--url", dest="url", metavar="TEMPLATE",
+                      help="URL template, with %s for the id")
+    parser.set_defaults(url=None)
+    parser.add_option("-i", "--ids", dest="idsfile", metavar="FILE",
+                      help="file with ids, one per line")
+    parser.set_defaults(idsfile=None)
+    parser.add_option("-o", "--ics", dest="icsfile", metavar="FILE",
+                      help="ics file")
+    parser.set_defaults(icsfile=None)
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int",
+                      metavar="N",
+                      help="number of pages to fetch at the same time "
+                      "(%default)")
+    parser.set_defaults(concurrency=8)
+    parser.add_option("-r", "--retries", dest="retries", type="int",
+                      help="number of times to retry a failed page "
+                      "(%default)")
+    parser.set_defaults(retries=3)
+    parser.add_option("-b", "--backoff", dest="backoff", type="float",
+                      metavar="SECONDS",
+                      help="wait before the first retry, doubled for each "
+                      "next one (%default)")
+    parser.set_defaults(backoff=0.5)
+    parser.add_option("-t", "--timeout", dest="timeout", type="float",
+                      metavar="SECONDS",
+                      help="network timeout (%default)")
+    parser.set_defaults(timeout=30.)
+    parser.add_option("-s", "--save", dest="savedir", metavar="DIR",
+                      help="also save the pages in DIR, as <id>.txt or <id>.html")
+    parser.set_defaults(savedir=None)
+    parser.add_option("-v", "--verbose", dest="debug", action="store_true",
+                     help="Output verbose debugging info (%default)")
+    parser.set_defaults(debug=False)
+
+    # get the options:
+    (options, args) = parser.parse_args()
+
+    options.ids = args
+    if options.idsfile:
+        for line in open(options.idsfile):
+            if line.strip() and not line.startswith('#'):
+                options.ids.append(line.strip())
+    if not options.ids:
+        parser.print_help()
+        print ""
+        print "ERROR: no ids given"
+        sys.exit(-1)
+    if not options.url or "%s" not in options.url:
+        parser.print_help()
+        print ""
+        print "ERROR: no URL template (with %s for the id) given"
+        sys.exit(-1)
+    if options.icsfile == None:
+        parser.print_help()
+        print ""
+        print "ERROR: no output file given"
+        sys.exit(-1)
+    if options.concurrency < 1 or options.retries < 0:
+        print "ERROR: need a concurrency of at least 1, and no negative retries"
+        sys.exit(-1)
+    if options.savedir and not os.path.isdir(options.savedir):
+        os.makedirs(options.savedir)
+
+    # we also want to return our version, for use in other output
+    version=parser.get_version()
+
+    # clean up (recommended):
+    del(parser)
+    return options, args, version
+
+######## FETCHING ##########
+
+class FetchError(Exception):
+    ''' a page could not be fetched, not even after retrying '''
+    pass
+
+class ConnectionPool(object):
+    ''' keeps idle keep-alive connections per host, for reuse by the
+    fetching threads '''
+
+    def __init__(self, timeout=30.):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        ''' returns an idle connection to <netloc>, or a new one '''
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(( scheme, netloc ))
+            if idle:
+                return idle.pop()
+        finally:
+            self.lock.release()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, connection):
+        ''' hands back a connection that can be used again '''
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(( scheme, netloc ), []).append(connection)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for connections in self.idle.itervalues():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+def fetch_page(pool, url, retries=3, backoff=0.5, log=None):
+    ''' fetches <url> over a connection from <pool>, trying again up to
+    <retries> times on network errors and temporary HTTP errors, after
+    waiting <backoff> seconds, doubled for every next try. Follows
+    redirects, and returns the page body. '''
+
+    redirects = 0
+    attempt = 0
+    while True:
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+        connection = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', path,
+                               headers={ 'Accept-Encoding': 'gzip' })
+            response = connection.getresponse()
+            body = response.read()
+        except httplib.InvalidURL, e:
+            # trying again won't make it any better:
+            connection.close()
+            raise FetchError("%s: %s" % ( url, e ))
+        except (socket.error, httplib.HTTPException), e:
+            # the connection is broken (or the server closed it):
+            connection.close()
+            error = "%s" % ( e or e.__class__.__name__ )
+        else:
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(parts.scheme, parts.netloc, connection)
+            status = response.status
+            if status in ( 301, 302, 303, 307, 308 ) and redirects < 5:
+                redirects += 1
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                continue
+            if status == 200:
+                if response.getheader('Content-Encoding') == 'gzip':
+                    body = zlib.decompress(body, 16+zlib.MAX_WBITS)
+                return body
+            error = "HTTP %d %s" % ( status, response.reason )
+            if status not in retry_statuses:
+                raise FetchError("%s: %s" % ( url, error ))
+        if attempt >= retries:
+            raise FetchError("%s: %s (after %d retries)" % \
+                             ( url, error, retries ))
+        # wait a bit longer every time, with some jitter so the
+        # threads don't all come back at once:
+        wait = backoff * 2**attempt * random.uniform(0.5, 1.5)
+        if log: log("Retrying %s in %.1fs (%s)" % ( url, wait, error ))
+        time.sleep(wait)
+        attempt += 1
+
+def fetch_pages(ids, url, concurrency=8, retries=3, backoff=0.5,
+                timeout=30., log=None):
+    ''' fetches the page of each id in <ids>, with <concurrency> threads
+    sharing a pool of keep-alive connections; <url> is a template with %s
+    for the id (quoted, so it may hold spaces or slashes). Yields ( id, page, error ) as soon as the page (and those
+    of the ids before it) are in, so the order is that of <ids>; page is
+    None if the page could not be fetched, and error then says why. '''
+
+    pool = ConnectionPool(timeout)
+    jobs = Queue.Queue()
+    done = Queue.Queue()
+    for index, id in enumerate(ids):
+        jobs.put(( index, id ))
+
+    def worker():
+        while True:
+            try:
+                index, id = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                page = fetch_page(pool, url % urllib.quote(id, safe=''),
+                                  retries, backoff, log)
+                done.put(( index, id, page, None ))
+            except Exception, e:
+                done.put(( index, id, None, str(e) ))
+
+    threads = [ threading.Thread(target=worker)
+                for n in range(min(concurrency, len(ids))) ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        waiting = {}
+        for index in range(len(ids)):
+            while index not in waiting:
+                result = done.get()
+                waiting[result[0]] = result[1:]
+            yield waiting.pop(index)
+    finally:
+        # stop handing out work (e.g. when the caller stops early):
+        while True:
+            try:
+                jobs.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in threads:
+            thread.join()
+        pool.close()
+
+def read_page(page, log=None):
+    ''' returns the entries on schedule <page>, pasted text or HTML '''
+
+    return rooster2ics.read_rooster(page, log=log)
+
+######## MAIN ##########
+
+if __name__ == "__main__":
+
+    # get commandline options and file(s)
+    (options, args, version) = parse_commandline()
+
+    log = rooster2ics.print_log
+    verbose_log = options.debug and log or None
+
+    entries = []
+    failed = []
+    for id, page, error in fetch_pages(options.ids, options.url,
+                                       options.concurrency, options.retries,
+                                       options.backoff, options.timeout,
+                                       log):
+        if page is None:
+            print "ERROR:", error
+            failed.append(id)
+            continue
+        if options.savedir:
+            lines, is_html = rooster2ics.sniff_html([ page ])
+            name = id+( is_html and ".html" or ".txt" )
+            outfile = open(os.path.join(options.savedir, name), 'wb')
+            outfile.write(page)
+            outfile.close()
+        page_entries = list(read_page(page, verbose_log))
+        print "Read", len(page_entries), "entries for", id
+        entries += page_entries
+
+    entries = rooster2ics.make_unique(entries, log)
+    entries = rooster2ics.compact_entries(entries, log=log)
+    print "Writing to", options.icsfile
+    outfile = open(options.icsfile, 'wb')
+    entries_unique = rooster2ics.write_ics_entries(outfile, entries, version,
+                                                   log=log,
+                                                   verbose=options.debug)
+    outfile.close()
+
+    print ""
+    print "Summary:"
+    print "Fetched", len(options.ids)-len(failed), "of", len(options.ids), \
+        "pages"
+    print "Wrote", entries_unique, "unique entries to", options.icsfile
+    if failed:
+        print "Failed:", " ".join(failed)
+        sys.exit(1)
+
+# last line
@@ -0,0 +1,363 @@
+#!/usr/bin/python
+
+# This software is provided as-is, and comes without any warranty whatsoever.
+# If it works for you, great, let me know! If it doesn't work for you, I'd be happy to try
+# and help you fix it. If it destroys your universe, too bad (you may still file a bug report).
+#
+# Serves the rooster files in a directory as ICS calendar feeds over HTTP,
+# for calendar programs to subscribe to:
+#
+#   /                      lists the feeds
+#   /<rooster>.ics         all events from rooster file <rooster>(.txt)
+#   /course/<Vakcode>.ics  the events of one course, from all rooster files
+#
+# Feeds are rendered once and kept in memory until one of their rooster files
+# changes. Clients get 304 Not Modified for If-None-Match / If-Modified-Since,
+# and gzip compressed feeds if they accept them.
+
+import sys
+import os
+import re
+import time
+import datetime
+import gzip
+import hashlib
+import urllib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from optparse import OptionParser
+from cStringIO import StringIO
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+import rooster2ics
+
+######## COMMAND LINE / INPUT STUFF ##########
+
+def parse_commandline():
+    usage = "%prog [options] <rooster directory>"
+    version = "0.1"
+    description = \
+        "%prog serves the rooster files in a directory as ICS calendar "\
+        "feeds: /<rooster>.ics for each rooster file, and "\
+        "/course/<Vakcode>.ics for each course."
+    parser = OptionParser(usage=usage, description=description,
+                          version="%prog "+version)
+
+    parser.add_option("-d", "--dir", dest="roosterdir", metavar="DIR",
+                      help="directory with rooster files")
+    parser.set_defaults(roosterdir=None)
+    parser.add_option("-H", "--host", dest="host",
+                      help="address to listen on (%default)")
+    parser.set_defaults(host="127.0.0.1")
+    parser.add_option("-p", "--port", dest="port", type="int",
+                      help="port to listen on (%default)")
+    parser.set_defaults(port=8080)
+    parser.add_option("-m", "--max-age", dest="maxage", type="int",
+                      metavar="SECONDS",
+                      help="how long clients may use a feed without asking "
+                      "again (%default)")
+    parser.set_defaults(maxage=300)
+    parser.add_option("-v", "--verbose", dest="debug", action="store_true",
+                     help="Log every request (%default)")
+    parser.set_defaults(debug=False)
+
+    # get the options:
+    (options, args) = parser.parse_args()
+
+    if len(args) and options.roosterdir==None:
+        options.roosterdir = args.pop(0)
+    if len(args):
+        parser.print_help()
+        print ""
+        print "ERROR: too many argument, or unknown option(s)"
+        print args
+        sys.exit(-1)
+    if options.roosterdir == None or not os.path.isdir(options.roosterdir):
+        parser.print_help()
+        print ""
+        print "ERROR: no rooster directory given"
+        sys.exit(-1)
+
+    # we also want to return our version, for use in other output
+    version=parser.get_version()
+
+    # clean up (recommended):
+    del(parser)
+    return options, args, version
+
+######## FEEDS ##########
+
+class Feed(object):
+    ''' one rendered feed: the calendar text (plain and gzipped), with the
+    signature of the rooster files it was rendered from '''
+
+    def __init__(self, signature, body, last_modified):
+        self.signature = signature
+        self.body = body
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.last_modified = int(last_modified)
+        buf = StringIO()
+        zipped = gzip.GzipFile(fileobj=buf, mode='wb', mtime=last_modified)
+        zipped.write(body)
+        zipped.close()
+        self.gzipped = buf.getvalue()
+        # a different representation needs its own entity tag:
+        self.gzip_etag = self.etag[:-1]+'-gzip"'
+
+class FeedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' HTTP server that keeps parsed rooster files and rendered feeds in
+    memory, and renders them again only when their rooster files change '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # how often to look for new or removed rooster files, in seconds:
+    rescan_interval = 1.
+
+    def __init__(self, address, roosterdir, version, maxage=300,
+                 log=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FeedHandler)
+        self.roosterdir = roosterdir
+        self.version = version
+        self.maxage = maxage
+        self.log = log
+        # guards the dicts below (but is not held while reading or
+        # rendering):
+        self.lock = threading.Lock()
+        # feed path -> lock held while rendering it:
+        self.render_locks = {}
+        # rooster file -> ( ( mtime, size ), entries, course codes ):
+        self.parsed = {}
+        # feed path -> Feed:
+        self.feeds = {}
+        self.scanned = 0
+        self.roosterfiles = {}
+
+    def rooster_files(self):
+        ''' returns a dict of feed name -> rooster file, of the rooster
+        files in our directory; the directory is listed at most once every
+        rescan_interval seconds '''
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now-self.scanned >= self.rescan_interval:
+                self.roosterfiles = {}
+                for roosterfile in \
+                        rooster2ics.expand_roosterfiles([ self.roosterdir ]):
+                    name = os.path.splitext(os.path.basename(roosterfile))[0]
+                    self.roosterfiles[name] = roosterfile
+                self.scanned = now
+            return self.roosterfiles
+        finally:
+            self.lock.release()
+
+    def parse(self, roosterfile, signature):
+        ''' returns the (unique) entries of <roosterfile> and the set of
+        their course codes, reading it again only if its <signature>
+        changed '''
+        self.lock.acquire()
+        try:
+            parsed = self.parsed.get(roosterfile)
+        finally:
+            self.lock.release()
+        if parsed and parsed[0] == signature:
+            return parsed[1:]
+        if self.log: self.log("Reading "+roosterfile)
+        entries = rooster2ics.make_unique(
+            rooster2ics.read_rooster_file(roosterfile))
+        courses = frozenset( entry.Vakcode for entry in entries )
+        self.lock.acquire()
+        try:
+            self.parsed[roosterfile] = ( signature, entries, courses )
+        finally:
+            self.lock.release()
+        return entries, courses
+
+    def render_lock(self, path):
+        ''' returns the lock that renders feed <path> one at a time '''
+        self.lock.acquire()
+        try:
+            return self.render_locks.setdefault(path, threading.Lock())
+        finally:
+            self.lock.release()
+
+    def feed(self, path):
+        ''' returns the Feed for URL <path>, or None if there is none.
+        Clients of a feed that is still good don't wait for anything being
+        rendered; a feed that changed is rendered by one client at a time,
+        and the others get it when it is done. '''
+        match = re.match(r'^/(?:course/)?([^/]+)\.ics$', path)
+        if not match:
+            return None
+        name = urllib.unquote(match.group(1))
+        course = path.startswith('/course/')
+        roosterfiles = self.rooster_files()
+        if course:
+            sources = sorted(roosterfiles.values())
+        elif name in roosterfiles:
+            sources = [ roosterfiles[name] ]
+        else:
+            return None
+        # a feed is still good while none of its files changed:
+        signature = []
+        for roosterfile in sources:
+            try:
+                st = os.stat(roosterfile)
+            except OSError: # removed since the last scan
+                continue
+            signature.append( ( roosterfile, st.st_mtime, st.st_size ) )
+        signature = tuple(signature)
+        feed = self.feeds.get(path)
+        if feed and feed.signature == signature:
+            return feed
+        # only known courses get a lock and are rendered, or any name
+        # asked for would take memory and time:
+        if course:
+            for roosterfile, mtime, size in signature:
+                if name in self.parse(roosterfile, ( mtime, size ))[1]:
+                    break
+            else:
+                return None
+        lock = self.render_lock(path)
+        lock.acquire()
+        try:
+            # rendered by another client while we waited?
+            feed = self.feeds.get(path)
+            if feed and feed.signature == signature:
+                return feed
+            entries = []
+            for roosterfile, mtime, size in signature:
+                entries += self.parse(roosterfile, ( mtime, size ))[0]
+            if course:
+                entries = [ entry for entry in entries
+                            if entry.Vakcode == name ]
+                if not entries:
+                    return None
+            entries = rooster2ics.compact_entries(
+                rooster2ics.make_unique(entries))
+            last_modified = max([ mtime for f, mtime, s in signature ] or
+                                [ time.time() ])
+            body = StringIO()
+            rooster2ics.write_ics_entries(
+                body, entries, self.version,
+                reference=datetime.datetime.fromtimestamp(last_modified))
+            feed = self.feeds[path] = Feed(signature, body.getvalue(),
+                                           last_modified)
+            if self.log:
+                self.log("Rendered %s: %d events" % ( path, len(entries) ))
+            return feed
+        finally:
+            lock.release()
+
+    def index(self):
+        ''' returns the list of feeds, as plain text '''
+        roosterfiles = self.rooster_files()
+        courses = set()
+        for name, roosterfile in roosterfiles.iteritems():
+            try:
+                st = os.stat(roosterfile)
+            except OSError:
+                continue
+            courses.update(self.parse(roosterfile,
+                                      ( st.st_mtime, st.st_size ))[1])
+        lines = [ "/%s.ics" % name for name in sorted(roosterfiles) ]
+        lines += [ "/course/%s.ics" % course for course in sorted(courses) ]
+        return "\n".join(lines)+"\n"
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' answers GET and HEAD requests for the feeds of our FeedServer '''
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path = self.path.split('?', 1)[0]
+        if path == '/':
+            try:
+                body = self.server.index()
+            except Exception, e:
+                self.send_error(500, "Could not list feeds: %s" % e)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not head: self.wfile.write(body)
+            return
+        try:
+            feed = self.server.feed(path)
+        except Exception, e:
+            self.send_error(500, "Could not render feed: %s" % e)
+            return
+        if feed is None:
+            self.send_error(404, "No such feed")
+            return
+
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag = gzipped and feed.gzip_etag or feed.etag
+        if self.not_modified(feed):
+            self.send_response(304)
+            self.send_feed_headers(feed, etag, gzipped)
+            self.end_headers()
+            return
+        body = gzipped and feed.gzipped or feed.body
+        self.send_response(200)
+        self.send_feed_headers(feed, etag, gzipped)
+        self.send_header("Content-Type", "text/calendar; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head: self.wfile.write(body)
+
+    def send_feed_headers(self, feed, etag, gzipped):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified",
+                         formatdate(feed.last_modified, usegmt=True))
+        self.send_header("Cache-Control", "max-age=%d" % self.server.maxage)
+        self.send_header("Vary", "Accept-Encoding")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+
+    def not_modified(self, feed):
+        ''' checks the conditional request headers against <feed> '''
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            # If-None-Match wins over If-Modified-Since (RFC 7232, 6):
+            tags = [ tag.strip() for tag in if_none_match.split(',') ]
+            tags = [ tag[2:] if tag.startswith('W/') else tag
+                     for tag in tags ]
+            return '*' in tags or feed.etag in tags or feed.gzip_etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            since = parsedate_tz(if_modified_since)
+            if since:
+                return feed.last_modified <= mktime_tz(since)
+        return False
+
+    def log_message(self, format, *args):
+        if self.server.log:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+######## MAIN ##########
+
+if __name__ == "__main__":
+
+    # get commandline options and file(s)
+    (options, args, version) = parse_commandline()
+
+    server = FeedServer(( options.host, options.port ), options.roosterdir,
+                        version, options.maxage,
+                        options.debug and rooster2ics.print_log or None)
+    print "Serving feeds from %s on http://%s:%d/" % \
+        ( options.roosterdir, options.host, options.port )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print ""
+    server.server_close()
+
+# last line
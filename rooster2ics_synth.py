@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+# This software is provided as-is, and comes without any warranty whatsoever.
+# If it works for you, great, let me know! If it doesn't work for you, I'd be happy to try
+# and help you fix it. If it destroys your universe, too bad (you may still file a bug report).
+#
+# Generates synthetic rooster files, laid out like the text pasted from the
+# rooster.vu.nl 'per week' view, for testing and benchmarking rooster2ics.
+
+import sys
+import random
+import datetime
+import itertools
+
+from optparse import OptionParser
+
+######## globals #########
+
+# header layouts, as found in the rooster.vu.nl exports:
+#  status:  Status and Dag columns
+#  plain:   Dag column, but no Status
+#  weekday: no Status or Dag column, rows grouped under weekday lines
+#  v1:      the older export: tables of some rows, each under a line of
+#           dates, with a Status column but no Groep column; the Docent
+#           cell can hold more than one line
+layouts = [ 'status', 'plain', 'weekday', 'v1' ]
+
+# shapes of the week ranges:
+#  single:  one week, like '37'
+#  range:   consecutive weeks, like '36-42'
+#  gaps:    ranges with gaps, like '36-42, 44'
+#  wrap:    a range into the next year, like '50-3'
+#  mixed:   any of the above
+week_shapes = [ 'single', 'range', 'gaps', 'wrap', 'mixed' ]
+
+days = [ ( 'ma', 'maandag' ), ( 'di', 'dinsdag' ), ( 'wo', 'woensdag' ),
+         ( 'do', 'donderdag' ), ( 'vr', 'vrijdag' ) ]
+types = [ 'HC', 'WC', 'PR', 'WG', 'TE' ]
+times = [ ( '08:45', '10:30' ), ( '11:00', '12:45' ), ( '13:30', '15:15' ),
+          ( '15:30', '17:15' ), ( '18:30', '21:00' ) ]
+
+######## COMMAND LINE / INPUT STUFF ##########
+
+def parse_commandline():
+    usage = "%prog [options] [rooster file]"
+    version = "0.1"
+    description = \
+        "%prog writes a synthetic rooster file, for testing and "\
+        "benchmarking rooster2ics."
+    parser = OptionParser(usage=usage, description=description,
+                          version="%prog "+version)
+
+    parser.add_option("-c", "--courses", dest="courses", type="int",
+                      help="number of courses (%default)")
+    parser.set_defaults(courses=20)
+    parser.add_option("-n", "--rows", dest="rows", type="int",
+                      help="number of rows (%default)")
+    parser.set_defaults(rows=1000)
+    parser.add_option("-w", "--weeks", dest="weeks", choices=week_shapes,
+                      help="shape of the week ranges, one of: %s (%%default)"
+                      % ", ".join(week_shapes))
+    parser.set_defaults(weeks="mixed")
+    parser.add_option("-g", "--groups", dest="groups", type="int",
+                      help="number of groups per course, 0 for no Groep "
+                      "column (%default)")
+    parser.set_defaults(groups=4)
+    parser.add_option("-l", "--layout", dest="layout", choices=layouts,
+                      help="header layout, one of: %s (%%default)"
+                      % ", ".join(layouts))
+    parser.set_defaults(layout="status")
+    parser.add_option("-d", "--duplicates", dest="duplicates", type="float",
+                      help="fraction of rows that repeat an earlier row "
+                      "(%default)")
+    parser.set_defaults(duplicates=0.1)
+    parser.add_option("-y", "--year", dest="year", type="int",
+                      help="year the academic year starts in (%default)")
+    parser.set_defaults(year=2016)
+    parser.add_option("-s", "--seed", dest="seed", type="int",
+                      help="random seed (%default)")
+    parser.set_defaults(seed=1)
+
+    # get the options:
+    (options, args) = parser.parse_args()
+
+    if len(args)>1:
+        parser.print_help()
+        print ""
+        print "ERROR: too many argument, or unknown option(s)"
+        print args
+        sys.exit(-1)
+    options.roosterfile = args and args[0] or None
+    if options.courses < 1 or options.rows < 0:
+        print "ERROR: need at least one course, and no negative rows"
+        sys.exit(-1)
+    if not 0 <= options.duplicates < 1:
+        print "ERROR: duplicate rate should be at least 0, and below 1"
+        sys.exit(-1)
+
+    # clean up (recommended):
+    del(parser)
+    return options, args
+
+######## GENERATING ##########
+
+def week_date(year, week, day):
+    ''' returns the date of weekday <day> (0 is monday) in ISO <week> '''
+
+    jan4 = datetime.date(year, 1, 4)
+    monday = jan4 - datetime.timedelta(days=jan4.weekday())
+    return monday + datetime.timedelta(weeks=week-1, days=day)
+
+def make_weeks(rng, shape, year):
+    ''' returns ( week numbers text, first week, year of first week ) '''
+
+    if shape == 'mixed':
+        shape = rng.choice(week_shapes[:-1])
+    if shape == 'wrap':
+        start = rng.randint(48, 51)
+        return "%d-%d" % ( start, rng.randint(1, 4) ), start, year
+    # most of the academic year's courses run in the autumn:
+    if rng.random() < 0.7:
+        start, last, first_year = rng.randint(36, 44), 51, year
+    else:
+        start, last, first_year = rng.randint(2, 14), 24, year+1
+    if shape == 'single':
+        return "%d" % start, start, first_year
+    end = min(start+rng.randint(1, 7), last-2)
+    if shape == 'range':
+        return "%d-%d" % ( start, end ), start, first_year
+    return "%d-%d, %d" % ( start, end, end+2 ), start, first_year
+
+def make_row(rng, options, course):
+    ''' returns the fields of a random row for <course>, as a tuple
+    ( day index, Vakcode, Begindatum, Kal.wkn, Start, Einde, Vaknaam,
+      Beschrijving, Groep, Type, Zalen, Docent, Opmerking ) '''
+
+    day = rng.randrange(len(days))
+    weeks, first_week, first_year = make_weeks(rng, options.weeks,
+                                               options.year)
+    date = week_date(first_year, first_week, day)
+    start, end = rng.choice(times)
+    if options.groups:
+        group = "Groep %s" % chr(ord('A')+rng.randrange(options.groups))
+    else:
+        group = None
+    return ( day, "X_%06d" % (400000+course),
+             "%d/%d/%02d" % ( date.day, date.month, date.year%100 ),
+             weeks, start, end, "Course %d" % course,
+             rng.choice([ "", "Lecture", "Tutorial", "Practical" ]),
+             group, rng.choice(types),
+             "WN-%s%d" % ( rng.choice("ABCFKMPS"), rng.randint(1, 700) ),
+             "Dr. L. %d" % rng.randint(1, options.courses*2),
+             rng.choice([ "", "", "", "bring laptop" ]) )
+
+def generate_rows(options):
+    ''' yields random rows, with the requested fraction of duplicates '''
+
+    rng = random.Random(options.seed)
+    seen = []
+    for n in xrange(options.rows):
+        if seen and rng.random() < options.duplicates:
+            row = rng.choice(seen)
+        else:
+            row = make_row(rng, options, rng.randrange(options.courses))
+            # keep a bounded sample to draw duplicates from:
+            if len(seen) < 10000:
+                seen.append(row)
+            else:
+                seen[rng.randrange(len(seen))] = row
+        yield row
+
+class Settings(object):
+    ''' options for write_rooster, when called from code rather than from
+    the command line (like Settings(courses=40, rows=2000, ...)) '''
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+
+def write_rooster(outfile, options):
+    ''' writes a synthetic rooster, as configured by <options> '''
+
+    headers = [ "Vakcode", "Dag", "Begindatum", "Kal.wkn", "Start", "Einde",
+                "Vaknaam", "Beschrijving", "Groep", "Type", "Zalen",
+                "Docent", "Opmerking" ]
+    with_groups = options.groups and options.layout != 'v1'
+    if not with_groups:
+        headers.remove("Groep")
+    if options.layout in ( 'status', 'v1' ):
+        headers.insert(0, "Status")
+    if options.layout == 'weekday':
+        headers.remove("Dag")
+
+    print >>outfile, "Rooster %d-%d" % ( options.year, options.year+1 )
+    print >>outfile, ""
+
+    def format_row(row):
+        words = list(row[1:])
+        if options.layout == 'v1' and row[1].endswith(('0', '5')):
+            # some courses have a second lecturer, on a line of its own:
+            words[10] += "\nDr. M. %s" % row[1][-2:]
+        if not with_groups:
+            del words[7]
+        if options.layout != 'weekday':
+            words.insert(1, days[row[0]][0])
+        if options.layout in ( 'status', 'v1' ):
+            words.insert(0, "")
+        return "\t".join(words)
+
+    if options.layout == 'v1':
+        # tables of up to 40 rows, each with a line of dates above it:
+        table = 0
+        rows = generate_rows(options)
+        while True:
+            chunk = list(itertools.islice(rows, 40))
+            if not chunk:
+                break
+            start = week_date(options.year, 36+table%15, 0)
+            end = start + datetime.timedelta(days=6)
+            print >>outfile, "%s - %s" % ( start.strftime("%d %b %Y"),
+                                           end.strftime("%d %b %Y") )
+            print >>outfile, " \t".join(headers)
+            for row in chunk:
+                print >>outfile, format_row(row)
+            print >>outfile, ""
+            table += 1
+    elif options.layout == 'weekday':
+        # rows go in a table under the line for their day:
+        per_day = [ [] for day in days ]
+        for row in generate_rows(options):
+            per_day[row[0]].append(row)
+        for day, rows in zip(days, per_day):
+            print >>outfile, day[1]
+            print >>outfile, " \t".join(headers)
+            for row in rows:
+                print >>outfile, format_row(row)
+    else:
+        print >>outfile, " \t".join(headers)
+        for row in generate_rows(options):
+            print >>outfile, format_row(row)
+
+######## MAIN ##########
+
+if __name__ == "__main__":
+
+    # get commandline options and file(s)
+    (options, args) = parse_commandline()
+
+    if options.roosterfile:
+        outfile = open(options.roosterfile, 'w')
+    else:
+        outfile = sys.stdout
+    write_rooster(outfile, options)
+    if outfile is not sys.stdout: outfile.close()
+
+# last line
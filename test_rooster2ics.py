@@ -0,0 +1,272 @@
+#!/usr/bin/python
+
+# This software is provided as-is, and comes without any warranty whatsoever.
+# If it works for you, great, let me know! If it doesn't work for you, I'd be happy to try
+# and help you fix it. If it destroys your universe, too bad (you may still file a bug report).
+#
+# Tests for the parts of rooster2ics that are easy to get subtly wrong:
+# fetching against a local stand-in server, making entries unique on disk,
+# and finding conflicts. Run with:
+#
+#   python -m unittest test_rooster2ics
+
+import datetime
+import threading
+import urllib
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from cStringIO import StringIO
+
+import rooster2ics
+import rooster2ics_fetch
+import rooster2ics_synth
+
+######## HELPERS ##########
+
+def synthetic_rooster(rows=2000, duplicates=0.2, seed=1, layout='status'):
+    ''' returns a synthetic rooster of <rows> rows, as text '''
+
+    outfile = StringIO()
+    rooster2ics_synth.write_rooster(outfile, rooster2ics_synth.Settings(
+        courses=40, rows=rows, weeks='mixed', groups=4, layout=layout,
+        duplicates=duplicates, year=2016, seed=seed))
+    return outfile.getvalue()
+
+def synthetic_entries(rows=2000, duplicates=0.2, seed=1):
+    ''' returns the entries of a synthetic rooster of <rows> rows '''
+
+    return list(rooster2ics.read_rooster(synthetic_rooster(rows, duplicates,
+                                                           seed)))
+
+def split_entries(entries, count=200):
+    ''' returns <entries>, with the first <count> of them that have more
+    than one week split in two, for compaction to merge again '''
+
+    entries = list(entries)
+    for entry in entries[:count]:
+        if len(entry.Weken) > 1:
+            second = datetime.date.fromordinal(
+                rooster2ics.academic_calendar.occurrences(
+                    entry.Begindatum, entry.Weken)[1])
+            entries.append(entry._replace(
+                Begindatum=( second.year, second.month, second.day ),
+                Weken=entry.Weken[1:]))
+    return entries
+
+def weekly_entry(year, weeks):
+    ''' returns an entry on the monday of ISO <weeks> (starting in <year>) '''
+
+    first = rooster2ics_synth.week_date(year, weeks[0], 0)
+    return rooster2ics.Entry('', 'X_400001', 'MO',
+                             ( first.year, first.month, first.day ),
+                             tuple(weeks), 9*60, 10*60+45, 'Course', '', '',
+                             'HC', 'WN-KC137', 'Dr. L. 1', '')
+
+def occurrences(entries):
+    ''' returns the set of dates each of <entries> occurs on, as ( entry
+    without its weeks, date ) '''
+
+    return set( ( entry._replace(Begindatum=None, Weken=None), date )
+                for entry in entries
+                for date in rooster2ics.academic_calendar.occurrences(
+                    entry.Begindatum, entry.Weken) )
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' serves /<id> as "page <id>", after answering 503 to the first
+    request for each id in <flaky>; ids in <missing> get 404 '''
+
+    daemon_threads = True
+
+    def __init__(self, flaky=(), missing=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ( '127.0.0.1', 0 ),
+                                           StandInHandler)
+        self.flaky = set(flaky)
+        self.missing = set(missing)
+        self.requests = []
+        self.lock = threading.Lock()
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        id = urllib.unquote(self.path.lstrip('/'))
+        server = self.server
+        server.lock.acquire()
+        try:
+            server.requests.append(id)
+            flaky = id in server.flaky
+            server.flaky.discard(id)
+        finally:
+            server.lock.release()
+        if flaky:
+            status, body = 503, "try again"
+        elif id in server.missing:
+            status, body = 404, "no such page"
+        else:
+            status, body = 200, "page "+id
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+######## TESTS ##########
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer(flaky=[ 'b', 'd' ], missing=[ 'c' ])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/%%s" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_order_retry_and_failure(self):
+        ids = [ 'a', 'b', 'c', 'd', 'e', 'f' ]
+        results = list(rooster2ics_fetch.fetch_pages(
+            ids, self.url, concurrency=3, retries=2, backoff=0.01))
+        # in the order of the ids, whatever order they came in:
+        self.assertEqual([ id for id, page, error in results ], ids)
+        pages = dict( ( id, page ) for id, page, error in results )
+        # the 503s were retried:
+        self.assertEqual(pages['b'], "page b")
+        self.assertEqual(pages['d'], "page d")
+        self.assertEqual(self.server.requests.count('b'), 2)
+        # a 404 is not retried, but reported:
+        self.assertEqual(pages['c'], None)
+        self.assertEqual(self.server.requests.count('c'), 1)
+        error = [ error for id, page, error in results if id == 'c' ][0]
+        self.assertTrue("404" in error)
+
+    def test_gives_up_after_retries(self):
+        self.server.flaky = set([ 'a' ])
+        results = list(rooster2ics_fetch.fetch_pages(
+            [ 'a' ], self.url, retries=0, backoff=0.01))
+        self.assertEqual(results[0][1], None)
+        self.assertTrue("503" in results[0][2])
+
+    def test_quotes_ids(self):
+        results = list(rooster2ics_fetch.fetch_pages(
+            [ 'Groep A', 'X/1' ], self.url, retries=2, backoff=0.01))
+        self.assertEqual([ page for id, page, error in results ],
+                         [ "page Groep A", "page X/1" ])
+        self.assertEqual(sorted(self.server.requests), [ 'Groep A', 'X/1' ])
+
+class ReadRoosterTest(unittest.TestCase):
+
+    def test_layouts(self):
+        # the parser for each sniffed layout reads what the generic one
+        # does, with the same lines skipped:
+        for layout, sniffed in [ ( 'status', 'table' ), ( 'plain', 'table' ),
+                                 ( 'weekday', 'weekday' ) ]:
+            text = synthetic_rooster(rows=500, layout=layout)
+            self.assertEqual(rooster2ics.sniff_layout(
+                text.splitlines(True))[1], sniffed)
+            stats, generic_stats = rooster2ics.Stats(), rooster2ics.Stats()
+            entries = list(rooster2ics.read_rooster(text, stats))
+            self.assertEqual(len(entries), 500)
+            self.assertEqual(entries, list(rooster2ics.read_vu_rooster(
+                text, generic_stats)))
+            self.assertEqual(stats.skipped, generic_stats.skipped)
+
+class EntryStoreTest(unittest.TestCase):
+
+    def test_same_as_make_unique(self):
+        entries = synthetic_entries()
+        store = rooster2ics.EntryStore(batchsize=97)
+        try:
+            # in several parts, like files:
+            for start in range(0, len(entries), 500):
+                store.add(entries[start:start+500])
+            self.assertEqual(store.count, len(entries))
+            self.assertEqual(list(store), rooster2ics.make_unique(entries))
+        finally:
+            store.close()
+
+    def test_same_as_compact_entries(self):
+        entries = split_entries(synthetic_entries())
+        store = rooster2ics.EntryStore()
+        try:
+            store.add(entries)
+            store.compact()
+            unique = rooster2ics.make_unique(entries)
+            compacted = rooster2ics.compact_entries(unique)
+            self.assertTrue(len(compacted) < len(unique))
+            self.assertEqual(list(store), compacted)
+            self.assertEqual(len(store), len(list(store)))
+        finally:
+            store.close()
+
+class CompactTest(unittest.TestCase):
+
+    def test_same_occurrences(self):
+        unique = rooster2ics.make_unique(split_entries(synthetic_entries()))
+        compacted = rooster2ics.compact_entries(unique)
+        self.assertTrue(len(compacted) < len(unique))
+        self.assertEqual(occurrences(compacted), occurrences(unique))
+
+    def test_longer_than_a_year(self):
+        # weeks 36-52, 2-26 and 36-40 of the next year: a series of those
+        # would only have week numbers for a year
+        entries = [ weekly_entry(2016, range(36, 53)),
+                    weekly_entry(2017, range(2, 27)),
+                    weekly_entry(2017, range(36, 41)) ]
+        compacted = rooster2ics.compact_entries(entries)
+        self.assertEqual(len(compacted), 2)
+        self.assertEqual(occurrences(compacted), occurrences(entries))
+        store = rooster2ics.EntryStore()
+        try:
+            store.add(entries)
+            store.compact()
+            self.assertEqual(occurrences(store), occurrences(entries))
+        finally:
+            store.close()
+
+class ConflictsTest(unittest.TestCase):
+
+    def pairwise(self, entries):
+        ''' the conflicts of <entries> found by comparing every pair, as
+        ( kind, resource, date, start, end ) with the pair of entries '''
+        calendar = rooster2ics.academic_calendar
+        found = set()
+        for i, first in enumerate(entries):
+            for second in entries[i+1:]:
+                start = max(first.Start, second.Start)
+                end = min(first.Einde, second.Einde)
+                if start >= end:
+                    continue
+                dates = set(calendar.occurrences(first.Begindatum,
+                                                 first.Weken)) & \
+                    set(calendar.occurrences(second.Begindatum, second.Weken))
+                for kind, field in rooster2ics.conflict_kinds:
+                    for resource in \
+                            set(rooster2ics.field_values(first, field)) & \
+                            set(rooster2ics.field_values(second, field)):
+                        for date in dates:
+                            found.add(( kind, resource,
+                                        datetime.date.fromordinal(date),
+                                        start, end,
+                                        frozenset([ first, second ]) ))
+        return found
+
+    def test_same_as_pairwise(self):
+        entries = rooster2ics.make_unique(synthetic_entries(rows=300))
+        found = set( ( c.kind, c.resource, c.date, c.start, c.end,
+                       frozenset([ c.first, c.second ]) ) for c in
+                     rooster2ics.find_conflicts(entries) )
+        self.assertTrue(found)
+        self.assertEqual(found, self.pairwise(entries))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# last line